@@ -0,0 +1,114 @@
+import os, shelve, sqlite3
+
+# Number of events resolved per sqlite query
+LOOKUP_CHUNK = 500
+
+
+def buildEventInfo(txt_f, db_f):
+    """ Bulk load the ensGene.map or locuslink.map files from Gene description file into a sqlite annotation store
+
+    Args:
+        txt_f (str/path): Directory/path to Gene description file, tab delimited event, gene, symb, desc
+        db_f (str): Name of the annotation store to be generated
+
+    Returns:
+        Nothing. Generates a sqlite database with one row per event: event, gene, symb, desc
+
+    """
+    if os.path.exists(db_f):
+        os.remove(db_f)
+    db = sqlite3.connect(db_f)
+    db.execute("PRAGMA journal_mode = OFF")
+    db.execute("PRAGMA synchronous = OFF")
+    db.execute("CREATE TABLE events (event TEXT PRIMARY KEY, gene TEXT, symb TEXT, desc TEXT)")
+
+    def rows():
+        for line in open(txt_f):
+            if not line.startswith("#"):
+                yield [x.decode('utf-8', 'replace') for x in line.strip().split("\t")]
+
+    db.executemany("INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?)", rows())
+    db.commit()
+    db.close()
+
+
+def isStore(db_f):
+    """ Return True if <db_f> is a sqlite annotation store rather than a shelve """
+    try:
+        return open(db_f, 'rb').read(16) == "SQLite format 3\x00"
+    except IOError:
+        return False
+
+
+def openEventInfo(db_f):
+    """ Open an event annotation, either a sqlite store from buildEventInfo or a legacy shelve from shelveEventToInfo
+
+    Args:
+        db_f (str): Annotation store or shelved dictionary db[event] = [gene, symb, desc]
+
+    Returns:
+        Database. Pass to lookupEventInfo.
+
+    """
+    if isStore(db_f):
+        return sqlite3.connect(db_f)
+    return shelve.open(db_f, 'r')
+
+
+# Annotations already loaded by this process, keyed on (path, mtime)
+_loaded = {}
+
+
+def loadEventInfo(db_f):
+    """ Load a whole event annotation into memory once, for reuse across many files
+
+    Args:
+        db_f (str): Annotation store from buildEventInfo or shelved dictionary db[event] = [gene, symb, desc]
+
+    Returns:
+        Dictionary. event -> (gene, symb, desc). Can be passed to lookupEventInfo, and is shared with forked worker processes.
+
+    """
+    path = os.path.abspath(db_f)
+    key = (path, os.path.getmtime(path) if os.path.exists(path) else None)
+    if key not in _loaded:
+        db = openEventInfo(db_f)
+        if isinstance(db, sqlite3.Connection):
+            eventToInfo = dict((row[0].encode('utf-8'), tuple([x.encode('utf-8') for x in row[1:]])) \
+                for row in db.execute("SELECT event, gene, symb, desc FROM events"))
+        else:
+            eventToInfo = dict((e, tuple(db[e])) for e in db.keys())
+        db.close()
+        _loaded.clear()
+        _loaded[key] = eventToInfo
+    return _loaded[key]
+
+
+def lookupEventInfo(db, events):
+    """ Resolve a column of event IDs at once
+
+    Args:
+        db (database): Annotation from openEventInfo or loadEventInfo
+        events (list): Event names
+
+    Returns:
+        List. [gene, symb, desc] for each event, in the order of <events>; ['n/a', 'n/a', 'n/a'] for unannotated events
+
+    """
+    eventToInfo = {}
+    if isinstance(db, sqlite3.Connection):
+        unique = list(set(events))
+        for i in range(0, len(unique), LOOKUP_CHUNK):
+            chunk = unique[i: i + LOOKUP_CHUNK]
+            query = "SELECT event, gene, symb, desc FROM events WHERE event IN (%s)" % \
+                ",".join(["?"] * len(chunk))
+            for row in db.execute(query, chunk):
+                eventToInfo[row[0].encode('utf-8')] = [x.encode('utf-8') for x in row[1:]]
+    else:
+        for e in set(events):
+            try:
+                eventToInfo[e] = list(db[e])
+            except KeyError:
+                pass
+    missing = ['n/a', 'n/a', 'n/a']
+    return [eventToInfo.get(e, missing) for e in events]
@@ -0,0 +1,167 @@
+import os, json, hashlib
+import misoStage
+
+# Completion marker written inside a finished output directory
+MARKER = '.miso_complete'
+# Summary completion marker, kept in the sample's MISO output directory so summary directories hold summaries only
+SUMMARY_MARKER = '.miso_summary_complete'
+
+
+def _hash(items):
+    h = hashlib.sha1()
+    for item in items:
+        h.update(str(item) + "\n")
+    return h.hexdigest()
+
+
+def _fileStamp(path):
+    st = os.stat(path)
+    return "%s\t%d\t%d" % (os.path.basename(path), st.st_size, int(st.st_mtime))
+
+
+def runKey(pickledDir, bamFile, readlen, overhanglen, paired_end, settings_f, manifest=None):
+    """ Hash the inputs and settings of a MISO run on a single bam file
+
+    Args:
+        pickledDir (str/path): Directory pointing towards pickled MISO annotations
+        bamFile (str/path): Sorted indexed bam file
+        readlen (int): Length of reads for bamFile
+        overhanglen (int): The required number of nucleotides to overlap a splice junction
+        paired_end (bool): Paired-End mode
+        settings_f (str/path): MISO settings file
+        manifest (str): Precomputed misoStage.manifestHash of <pickledDir>, to avoid rehashing it for every sample
+
+    Returns:
+        Tuple. (inputs hash, settings hash). Inputs are identified by file name, size and mtime, so moving a bam keeps its hash.
+
+    """
+    if manifest is None:
+        manifest = misoStage.manifestHash(pickledDir)
+    inputs = _hash([manifest, _fileStamp(bamFile), _fileStamp(bamFile + '.bai')])
+    settings = _hash([open(settings_f).read(), int(readlen), int(overhanglen), paired_end])
+    return inputs, settings
+
+
+def writeMarker(marker_f, info):
+    """ Atomically write a completion marker
+
+    Args:
+        marker_f (str/path): Marker file
+        info (dict): Marker contents, i.e. inputs hash, settings hash and event counts
+
+    Returns:
+        Nothing. The marker is written to a temporary file and renamed into place.
+
+    """
+    tmp = marker_f + '.tmp.%d' % os.getpid()
+    out = open(tmp, 'w')
+    json.dump(info, out, sort_keys=True)
+    out.close()
+    os.rename(tmp, marker_f)
+
+
+def readMarker(marker_f):
+    """ Return the contents of a completion marker, or None if it is missing or unreadable """
+    try:
+        return json.load(open(marker_f))
+    except (IOError, ValueError):
+        return None
+
+
+def isComplete(marker_f, inputs, settings):
+    """ Check whether a unit of work finished with the same inputs and settings
+
+    Args:
+        marker_f (str/path): Marker file
+        inputs (str): Inputs hash of the unit
+        settings (str): Settings hash of the unit
+
+    Returns:
+        Bool. True only if the marker exists and records the same inputs and settings hashes
+
+    """
+    info = readMarker(marker_f)
+    return info is not None and info.get('inputs') == inputs and \
+        info.get('settings') == settings
+
+
+def markSample(outdir, inputs, settings):
+    """ Write per-chromosome and per-sample completion markers for a finished MISO run
+
+    Args:
+        outdir (str/path): MISO output directory of the sample
+        inputs (str): Inputs hash from runKey
+        settings (str): Settings hash from runKey
+
+    Returns:
+        Nothing. Writes <outdir>/<chrom>/.miso_complete with the chromosome's event count, then <outdir>/.miso_complete
+
+    """
+    chromToEvents = {}
+    for chrom in os.listdir(outdir):
+        chromDir = os.path.join(outdir, chrom)
+        if os.path.isdir(chromDir) and chrom not in misoStage.SYNC_SKIP:
+            n = len([f for f in os.listdir(chromDir) if f.endswith(".miso")])
+            writeMarker(os.path.join(chromDir, MARKER), {'events': n})
+            chromToEvents[chrom] = n
+    writeMarker(os.path.join(outdir, MARKER), {'inputs': inputs, 'settings': settings, \
+        'events': sum(chromToEvents.values()), 'chroms': chromToEvents})
+
+
+def dependencyKey(*dirs):
+    """ Hash the sample markers a derived unit (comparison, summary) was computed from """
+    return _hash([json.dumps(readMarker(os.path.join(d, MARKER)), sort_keys=True) \
+        for d in dirs])
+
+
+def comparisonMarker(outDir, sample1, sample2):
+    """ Return the marker file of a MISO comparison between two samples """
+    return os.path.join(outDir, sample1 + "_vs_" + sample2, MARKER)
+
+
+def markComparison(eventDir, outDir, sample1, sample2):
+    """ Write the completion marker of a finished MISO comparison
+
+    Args:
+        eventDir (str/path): Directory pointing towards pickled MISO results
+        outDir (str/path): Directory where MISO comparison results are stored
+        sample1 (str): First sample of the comparison
+        sample2 (str): Second sample of the comparison
+
+    Returns:
+        Nothing. No marker is written if the comparison produced no bayes factor file.
+
+    """
+    name = sample1 + "_vs_" + sample2
+    bf_f = os.path.join(outDir, name, 'bayes-factors', name + ".miso_bf")
+    if not os.path.exists(bf_f):
+        print 'No bayes factors for', name
+        return
+    n = len([line for line in open(bf_f) if not line.startswith("event_name")])
+    writeMarker(comparisonMarker(outDir, sample1, sample2), {'inputs': \
+        dependencyKey(os.path.join(eventDir, sample1), os.path.join(eventDir, sample2)), \
+        'settings': '', 'events': n})
+
+
+def summaryMarker(samples_dir):
+    """ Return the marker file of the summary of a sample """
+    return os.path.join(samples_dir, SUMMARY_MARKER)
+
+
+def markSummary(samples_dir, summary_fname):
+    """ Write the summary completion marker of a finished sample summary
+
+    Args:
+        samples_dir (str/path): MISO output directory of the sample
+        summary_fname (str/path): Summary file generated from <samples_dir>
+
+    Returns:
+        Nothing. Writes <samples_dir>/.miso_summary_complete, recording <summary_fname> as its settings. No marker is written if the summary file is missing.
+
+    """
+    if not os.path.exists(summary_fname):
+        print 'No summary', summary_fname
+        return
+    n = len([line for line in open(summary_fname) if not line.startswith("event_name")])
+    writeMarker(summaryMarker(samples_dir), {'inputs': dependencyKey(samples_dir), \
+        'settings': os.path.abspath(summary_fname), 'events': n})
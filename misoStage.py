@@ -0,0 +1,357 @@
+import os, time, shutil, hashlib, fcntl, errno, threading
+from multiprocessing.pool import ThreadPool
+
+# Number of unreferenced annotation copies kept in a node-local cache
+CACHE_ENTRIES = 2
+
+
+def manifestHash(pickledDir):
+    """ Hash the manifest of a pickled MISO annotation directory
+
+    Args:
+        pickledDir (str/path): Directory pointing towards pickled MISO annotations
+
+    Returns:
+        String. sha1 hex digest of the relative path, size and mtime of every file in <pickledDir>
+
+    """
+    h = hashlib.sha1()
+    for root, dirs, files in os.walk(pickledDir):
+        dirs.sort()
+        for f in sorted(files):
+            path = os.path.join(root, f)
+            st = os.stat(path)
+            h.update("%s\t%d\t%d\n" % (os.path.relpath(path, pickledDir), \
+                st.st_size, int(st.st_mtime)))
+    return h.hexdigest()
+
+
+# ioctl request for cloning a file (reflink) on btrfs/xfs
+FICLONE = 0x40049409
+
+# MISO output subdirectories that are still written to while genes are computed
+SYNC_SKIP = ['batch-genes', 'batch-logs', 'cluster_scripts', 'logs']
+
+
+def makedirs(path):
+    """ Make a directory and its parents, without failing if it already exists """
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _md5(path):
+    h = hashlib.md5()
+    f = open(path, 'rb')
+    for block in iter(lambda: f.read(1 << 20), ''):
+        h.update(block)
+    f.close()
+    return h.hexdigest()
+
+
+def _reflink(src, dst):
+    s = open(src, 'rb')
+    d = open(dst, 'wb')
+    try:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    finally:
+        s.close()
+        d.close()
+
+
+def copyFile(src, dst, link=True, checksum=False):
+    """ Copy a single file, following symbolic links (like cp -fL).
+
+    Args:
+        src (str/path): File to copy
+        dst (str/path): Destination file name, overwritten if it exists
+        link (bool): If source and destination share a filesystem, hardlink or reflink instead of copying
+        checksum (bool): Compare md5 sums of source and destination after a byte copy
+
+    Returns:
+        String. How the file was staged <link/reflink/copy>
+
+    """
+    src = os.path.realpath(src)
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if link and os.stat(src).st_dev == os.stat(os.path.dirname(os.path.abspath(dst))).st_dev:
+        try:
+            os.link(src, dst)
+            return 'link'
+        except OSError:
+            pass
+        try:
+            _reflink(src, dst)
+            shutil.copystat(src, dst)
+            return 'reflink'
+        except (IOError, OSError):
+            if os.path.lexists(dst):
+                os.remove(dst)
+    shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+    if checksum and _md5(src) != _md5(dst):
+        raise IOError("Checksum mismatch copying %s to %s" % (src, dst))
+    return 'copy'
+
+
+def stage(pairs, nthreads=4, link=True, checksum=False):
+    """ Copy files in parallel threads.
+
+    Args:
+        pairs (list): [source, destination] file pairs
+        nthreads (int): Number of copy threads
+        link (bool): If source and destination share a filesystem, hardlink or reflink instead of copying
+        checksum (bool): Compare md5 sums of source and destination after a byte copy
+
+    Returns:
+        Nothing. Raises IOError listing every failed transfer once all transfers have finished.
+
+    """
+    def transfer(pair):
+        try:
+            copyFile(pair[0], pair[1], link=link, checksum=checksum)
+            return None
+        except (IOError, OSError), e:
+            return "%s -> %s: %s" % (pair[0], pair[1], e)
+
+    if len(pairs) == 0:
+        return
+    pool = ThreadPool(max(1, min(int(nthreads), len(pairs))))
+    try:
+        failed = [x for x in pool.map(transfer, pairs) if x is not None]
+    finally:
+        pool.close()
+        pool.join()
+    if len(failed) > 0:
+        raise IOError("%d of %d transfers failed:\n%s" % (len(failed), len(pairs), \
+            "\n".join(failed)))
+
+
+def copyTree(srcDir, dstDir, nthreads=4, link=True, checksum=False):
+    """ Copy the contents of a directory into another directory (like cp -r srcDir/* dstDir).
+
+    Args:
+        srcDir (str/path): Directory to copy from
+        dstDir (str/path): Directory to copy into, created if missing
+        nthreads (int): Number of copy threads
+        link (bool): If source and destination share a filesystem, hardlink or reflink instead of copying
+        checksum (bool): Compare md5 sums of source and destination after a byte copy
+
+    Returns:
+        Nothing. Raises IOError if any file could not be copied.
+
+    """
+    pairs = []
+    for root, dirs, files in os.walk(srcDir, followlinks=True):
+        rel = os.path.relpath(root, srcDir)
+        makedirs(os.path.normpath(os.path.join(dstDir, rel)))
+        for f in files:
+            pairs.append([os.path.join(root, f), \
+                os.path.normpath(os.path.join(dstDir, rel, f))])
+    stage(pairs, nthreads, link=link, checksum=checksum)
+
+
+def removePath(path):
+    """ Remove a file or a directory tree (like rm -fr) """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def syncTree(srcDir, dstDir, settle=60, nthreads=4):
+    """ Move finished MISO event files from a scratch output directory to their final location.
+
+    Args:
+        srcDir (str/path): MISO output directory in scratch
+        dstDir (str/path): Final output directory
+        settle (int): Only move files that have not been modified for <settle> seconds
+        nthreads (int): Number of copy threads
+
+    Returns:
+        Int. Number of files moved. Files land under a temporary name and are renamed once complete.
+
+    """
+    now = time.time()
+    pairs = []
+    for root, dirs, files in os.walk(srcDir):
+        if root == srcDir:
+            dirs[:] = [d for d in dirs if d not in SYNC_SKIP]
+            continue
+        for f in files:
+            path = os.path.join(root, f)
+            if f.endswith(".miso") and now - os.path.getmtime(path) >= settle:
+                pairs.append([path, os.path.join(dstDir, os.path.relpath(path, srcDir))])
+    if len(pairs) == 0:
+        return 0
+
+    for d in set([os.path.dirname(p[1]) for p in pairs]):
+        makedirs(d)
+    stage([[src, dst + '.part'] for src, dst in pairs], nthreads)
+    for src, dst in pairs:
+        os.rename(dst + '.part', dst)
+        os.remove(src)
+    return len(pairs)
+
+
+def startSync(srcDir, dstDir, interval=300, settle=60):
+    """ Start moving finished MISO event files back in a background thread while MISO is running.
+
+    Args:
+        srcDir (str/path): MISO output directory in scratch
+        dstDir (str/path): Final output directory
+        interval (int): Seconds between passes over <srcDir>
+        settle (int): Only move files that have not been modified for <settle> seconds
+
+    Returns:
+        Tuple. Handle to pass to stopSync
+
+    """
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                n = syncTree(srcDir, dstDir, settle)
+                if n > 0:
+                    print 'Synced', n, 'files to', dstDir
+            except (IOError, OSError), e:
+                print 'Sync failed, retrying next pass:', e
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return stop, thread
+
+
+def stopSync(sync):
+    """ Stop a background sync started with startSync and wait for the pass in progress to finish """
+    stop, thread = sync
+    stop.set()
+    thread.join()
+
+
+def _lock(cacheDir):
+    lock = open(os.path.join(cacheDir, '.lock'), 'a')
+    fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+    return lock
+
+
+def _unlock(lock):
+    fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+    lock.close()
+
+
+def _pidAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _liveRefs(entry):
+    """ Return the reference tokens of <entry>, dropping those left behind by dead jobs """
+    refdir = entry + '.refs'
+    if not os.path.isdir(refdir):
+        return []
+    refs = []
+    for token in os.listdir(refdir):
+        if _pidAlive(int(token.split(".")[0])):
+            refs.append(token)
+        else:
+            os.remove(os.path.join(refdir, token))
+    return refs
+
+
+def _entries(cacheDir):
+    return [os.path.join(cacheDir, f) for f in os.listdir(cacheDir) \
+        if not f.startswith(".") and not f.endswith(".refs") and \
+        ".tmp." not in f and os.path.isdir(os.path.join(cacheDir, f))]
+
+
+def _clearPartial(cacheDir):
+    """ Remove partial copies left by jobs killed while populating; call with the cache lock held """
+    for f in os.listdir(cacheDir):
+        path = os.path.join(cacheDir, f)
+        if ".tmp." in f and os.path.isdir(path):
+            print 'Removing partial copy', path
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _evict(cacheDir, keep):
+    """ Remove least recently used unreferenced entries, keeping at most <keep> of them """
+    unused = [e for e in _entries(cacheDir) if len(_liveRefs(e)) == 0]
+    unused.sort(key=os.path.getmtime, reverse=True)
+    for entry in unused[keep:]:
+        print 'Evicting', entry
+        shutil.rmtree(entry, ignore_errors=True)
+        shutil.rmtree(entry + '.refs', ignore_errors=True)
+
+
+def acquireAnnotation(pickledDir, cacheDir, keep=CACHE_ENTRIES, key=None):
+    """ Get a node-local copy of a pickled annotation directory, shared between concurrent jobs.
+
+    Args:
+        pickledDir (str/path): Directory pointing towards pickled MISO annotations
+        cacheDir (str/path): Node-local directory (i.e. in scratch) holding the cached annotation copies
+        keep (int): Number of unreferenced annotation copies left in the cache after eviction
+        key (str): Precomputed manifestHash of <pickledDir>, to avoid walking it again
+
+    Returns:
+        Tuple. (path to the cached annotation copy, reference token to hand back to releaseAnnotation)
+
+    """
+    pickledDir = os.path.abspath(pickledDir).rstrip("/")
+    makedirs(cacheDir)
+    if key is None:
+        key = manifestHash(pickledDir)
+    entry = os.path.join(cacheDir, os.path.basename(pickledDir) + "." + key[:16])
+
+    # Hold the cache lock while populating, so jobs landing on the same node
+    # wait for the first copy instead of making their own.
+    lock = _lock(cacheDir)
+    try:
+        # Copies are only made under the lock, so any tmp dir seen here is stale
+        _clearPartial(cacheDir)
+        if not os.path.isdir(entry):
+            tmp = entry + ".tmp.%d" % os.getpid()
+            print 'Caching', pickledDir, 'to', entry
+            copyTree(pickledDir, tmp)
+            os.rename(tmp, entry)
+        makedirs(entry + '.refs')
+        token = "%d.%s" % (os.getpid(), repr(time.time()))
+        open(os.path.join(entry + '.refs', token), 'w').close()
+        # mtime of the entry is its last use for LRU eviction
+        os.utime(entry, None)
+        _evict(cacheDir, keep)
+    finally:
+        _unlock(lock)
+
+    return entry, token
+
+
+def releaseAnnotation(entry, token, keep=CACHE_ENTRIES):
+    """ Drop a reference taken with acquireAnnotation and evict unused cache entries.
+
+    Args:
+        entry (str/path): Cached annotation copy returned by acquireAnnotation
+        token (str): Reference token returned by acquireAnnotation
+        keep (int): Number of unreferenced annotation copies left in the cache after eviction
+
+    Returns:
+        Nothing. The copy stays in the cache until it is among the least recently used unreferenced entries.
+
+    """
+    cacheDir = os.path.dirname(entry)
+    lock = _lock(cacheDir)
+    try:
+        ref = os.path.join(entry + '.refs', token)
+        if os.path.exists(ref):
+            os.remove(ref)
+        _evict(cacheDir, keep)
+    finally:
+        _unlock(lock)
@@ -0,0 +1,191 @@
+from numpy import *
+
+# Number of samples re-ranked against another sample at once by a Spearman
+# correlation with missing values; small blocks stay in cache
+RERANK_BLOCK = 8
+
+
+def ciIndices(n, ci=.95):
+    """ Indices of the credible interval bounds among <n> sorted posterior samples
+
+    Args:
+        n (int): Number of posterior samples
+        ci (float): Credible interval level
+
+    Returns:
+        Tuple. (low index, high index); the lower bound is the (alpha/2)*n nth smallest sample, the upper bound the (1-alpha/2)*n nth smallest, both kept within the samples
+
+    """
+    alpha = 1 - ci
+    low = int(round((alpha / 2) * n) - 1)
+    high = int(round((1 - alpha / 2) * n) - 1)
+    return min(max(low, 0), n - 1), min(max(high, 0), n - 1)
+
+
+def posteriorStats(posteriors, cis=[.95]):
+    """ Mean, standard deviation, median and credible intervals for a batch of posterior distributions
+
+    Args:
+        posteriors (list): Sampled psi values, one array per event of shape (samples,) or (samples, isoforms). Events may differ in number of samples and isoforms.
+        cis (list): Credible interval levels to compute
+
+    Returns:
+        List. One dictionary per event with 'mean', 'std' and 'median' arrays (one value per isoform) and 'ci', a dictionary level -> (low array, high array)
+
+    """
+    # Stack events of identical shape and handle each stack in one pass
+    shapeToIdx = {}
+    arrays = []
+    for i in range(len(posteriors)):
+        p = asarray(posteriors[i], dtype=float)
+        if p.ndim == 1:
+            p = p[:, newaxis]
+        arrays.append(p)
+        shapeToIdx.setdefault(p.shape, []).append(i)
+
+    stats = [None] * len(arrays)
+    for shape, idx in shapeToIdx.items():
+        n = shape[0]
+        block = array([arrays[i] for i in idx])
+        means = block.mean(axis=1)
+        stds = block.std(axis=1)
+
+        # Only the order statistics we need are put in place, no full sort
+        bounds = dict([(ci, ciIndices(n, ci)) for ci in cis])
+        mids = sorted(set([(n - 1) // 2, n // 2]))
+        kth = sorted(set(mids + [k for b in bounds.values() for k in b]))
+        part = partition(block, kth, axis=1)
+        medians = part[:, mids, :].mean(axis=1)
+
+        for j in range(len(idx)):
+            stats[idx[j]] = {'mean': means[j], 'std': stds[j], 'median': medians[j], \
+                'ci': dict([(ci, (part[j, bounds[ci][0]], part[j, bounds[ci][1]])) \
+                for ci in cis])}
+    return stats
+
+
+def rankdata(values):
+    """ Ranks of <values>, 1 for the smallest; tied values share the average of their ranks """
+    values = asarray(values)
+    order = argsort(values, kind='mergesort')
+    ordered = values[order]
+    first = concatenate([[True], ordered[1:] != ordered[:-1]])
+    dense = cumsum(first)[argsort(order, kind='mergesort')]
+    ends = concatenate([nonzero(first)[0], [len(values)]])
+    return .5 * (ends[dense] + ends[dense - 1] + 1)
+
+
+def _pearsonBlocks(X, block):
+    # Sums over the observations present in both columns of every pair, one
+    # block of columns against another at a time so memory stays at block**2
+    present = (~isnan(X)).astype(float)
+    X = where(present > 0, X - nanmean(X, axis=0), 0)
+    X2 = X ** 2
+    p = X.shape[1]
+    cc = empty((p, p))
+    for i in range(0, p, block):
+        a = slice(i, i + block)
+        for j in range(i, p, block):
+            b = slice(j, j + block)
+            n = dot(present[:, a].T, present[:, b])
+            sx = dot(X[:, a].T, present[:, b])
+            sy = dot(present[:, a].T, X[:, b])
+            sxx = dot(X2[:, a].T, present[:, b])
+            syy = dot(present[:, a].T, X2[:, b])
+            sxy = dot(X[:, a].T, X[:, b])
+            with errstate(divide='ignore', invalid='ignore'):
+                r = (n * sxy - sx * sy) / sqrt((n * sxx - sx ** 2) * (n * syy - sy ** 2))
+            cc[a, b] = r
+            cc[b, a] = r.T
+    return clip(cc, -1, 1)
+
+
+def correlation(X, method='pearson', block=256):
+    """ Correlation between the columns of a matrix with missing values, using pairwise complete observations
+
+    Args:
+        X (array): Matrix of observations (rows) by variables (columns), i.e. events by samples; missing values are NaN
+        method (str): pearson or spearman
+        block (int): Number of columns correlated against each other at once
+
+    Returns:
+        Array. Variables by variables correlation matrix; NaN for pairs sharing fewer than two distinct observations
+
+    """
+    X = asarray(X, dtype=float)
+    block = int(block)
+    if method == 'pearson':
+        return _pearsonBlocks(X, block)
+    if method != 'spearman':
+        raise ValueError("Unknown correlation method %s" % method)
+
+    missing = isnan(X)
+    n, p = X.shape
+    # Samples are rows here, so each sample's events are contiguous. Sort every
+    # sample once (NaN last) and find the first and last sorted position of
+    # each event's run of tied values.
+    XT = ascontiguousarray(X.T)
+    missingT = ascontiguousarray(missing.T)
+    rows = arange(p)[:, newaxis]
+    order = argsort(XT, axis=1, kind='mergesort')
+    ordered = XT.ravel().take(order + rows * n)
+    idx = arange(n)[newaxis, :]
+    starts = ones((p, n), dtype=bool)
+    starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    ends = ones((p, n), dtype=bool)
+    ends[:, :-1] = starts[:, 1:]
+    first = maximum.accumulate(where(starts, idx, 0), axis=1)
+    last = minimum.accumulate(where(ends, idx, n)[:, ::-1], axis=1)[:, ::-1]
+    position = empty((p, n), dtype=int)
+    position[rows, order] = idx
+    # Back in event order, as indices into running counts over sorted
+    # positions (flattened samples x (events + 1)): the counts before and
+    # through each event's run of ties
+    first = first.ravel().take(position + rows * n) + rows * (n + 1)
+    last = last.ravel().take(position + rows * n) + rows * (n + 1) + 1
+
+    ranks = (first + last - 2 * rows * (n + 1) + 1) / 2.
+    ranks[missingT] = nan
+    cc = _pearsonBlocks(ranks.T, block)
+
+    # Pairs involving a sample with missing values are ranked again over the
+    # events they share: a rank drops by the smaller values, and half the tied
+    # values, sitting in events the other sample is missing. Running counts of
+    # the dropped events in sorted order give both at once.
+    incomplete = missing.any(axis=0)
+    counts = zeros((p, n + 1), dtype=int32)
+    step = min(block, RERANK_BLOCK)
+    for k in nonzero(incomplete)[0]:
+        offset = (rows[:step] - rows[k]) * (n + 1)
+        kfirst = first[k] + offset
+        klast = last[k] + offset
+        for j in range(0, p, step):
+            B = slice(j, min(j + step, p))
+            if j + step <= k and incomplete[B].all():
+                continue
+            m = B.stop - B.start
+            shared = ~missingT[k] & ~missingT[B]
+
+            # Ranks of each sample l leaving out events missing in k
+            cumsum(missingT[k].take(order[B]), axis=1, out=counts[B, 1:])
+            flat = counts.ravel()
+            lranks = ranks[B] - .5 * (flat.take(first[B]) + flat.take(last[B]))
+            # Ranks of k leaving out events missing in each sample l
+            cumsum(missingT[B].take(order[k], axis=1), axis=1, out=counts[:m, 1:])
+            kranks = ranks[k] - .5 * (flat.take(kfirst[:m]) + flat.take(klast[:m]))
+
+            r = _rankPearson(kranks, lranks, shared)
+            cc[k, B] = r
+            cc[B, k] = r
+    return cc
+
+
+def _rankPearson(a, b, mask):
+    # Pearson correlation of each pair of rows of ranks <a> and <b> over the
+    # columns in <mask>; ranks within the mask average (count + 1) / 2
+    centre = (mask.sum(axis=1) + 1) / 2.
+    a = where(mask, a - centre[:, newaxis], 0)
+    b = where(mask, b - centre[:, newaxis], 0)
+    with errstate(divide='ignore', invalid='ignore'):
+        r = einsum('ij,ij->i', a, b) / sqrt(einsum('ij,ij->i', a, a) * einsum('ij,ij->i', b, b))
+    return clip(r, -1, 1)
@@ -1,7 +1,7 @@
 import os, sys, shelve, operator, subprocess, time
-from misopy.settings import Settings, load_settings
-import Mypbm, Mysge
-from pylab import *
+import misoStage, misoCheckpoint, misoAnnotation
+from numpy import *
+from numpy.random import shuffle
 import random
 
 
@@ -21,10 +21,10 @@ def runMISO(bamDir, pickledDir, outDir,\
         PEdist_f (bool): Paired-End mode. Currently MISO cannot handle paired-end data, this flag defaults to <False>
 
     Returns:
-        Nothing. Generates a directory <outDir> where pickled MISO events and PSI values are stored.
+        Nothing. Generates a directory <outDir> where pickled MISO events and PSI values are stored. Samples whose completion marker matches the current inputs and settings are skipped.
 
     """
-    import pysam
+    import Mypbm, Mysge
     bamDir = os.path.abspath(os.path.expanduser(bamDir))
     pickledDir = os.path.abspath(os.path.expanduser(pickledDir))
     outDir = os.path.abspath(os.path.expanduser(outDir))
@@ -39,6 +39,19 @@ def runMISO(bamDir, pickledDir, outDir,\
                 fileToPE[file.split(".")[0]] = [mean,sd]   
 
     files = [f for f in os.listdir(bamDir) if f.endswith(".bam")]
+    manifest = misoStage.manifestHash(pickledDir)
+
+    # Get read lengths of all bam files up front
+    bamToLengths = getReadLengths([os.path.join(bamDir, f) for f in files])
+    for f in files:
+        if len(bamToLengths[os.path.join(bamDir, f)]) == 0:
+            exit('Read length could not be obtained for %s!' % f)
+    mixed = [f for f in files if len(bamToLengths[os.path.join(bamDir, f)]) > 1]
+    if len(mixed) > 0:
+        print 'WARNING: MISO cannot process mixed read lengths. Using the most frequent length for:'
+        for f in mixed:
+            print '\t', f, ",".join(map(str, bamToLengths[os.path.join(bamDir, f)]))
+
     for f in files:
         fname = f.split(".")[0]
         if fname in fileToPE:
@@ -46,17 +59,15 @@ def runMISO(bamDir, pickledDir, outDir,\
         else:
             PEinfo = False 
 
-        # Get read length
-        bam = pysam.Samfile(os.path.join(bamDir, f), 'rb')
-        readlen = False 
-        for read in bam.fetch():
-            readlen = int(read.qlen)
-            break 
-        if readlen == False:
-            exit('Read length could not be obtained!')
+        readlen = bamToLengths[os.path.join(bamDir, f)][0]
  
         outdir = os.path.abspath(os.path.join(outDir, fname))
-        if not os.path.exists(outdir):
+        inputs, settings = misoCheckpoint.runKey(pickledDir, os.path.join(bamDir, f), \
+            readlen, overhanglen, PEinfo, settings_f, manifest=manifest)
+        if misoCheckpoint.isComplete(os.path.join(outdir, misoCheckpoint.MARKER), \
+            inputs, settings):
+            print 'Skipping completed', fname
+        else:
             if queue != 'False':
                 scriptOptions = {'ppn':ppn, 'jobname':f}
                 if clustertype == 'torque':
@@ -90,8 +101,73 @@ def runMISO(bamDir, pickledDir, outDir,\
                     settings_f)
 
 
+def getReadLengths(bamFiles, nreads=1000, nthreads=8):
+    """ Probe the read lengths of bam files concurrently. Results are cached in a <bam>.readlen sidecar keyed on the bam mtime.
+
+    Args:
+        bamFiles (list): Paths to sorted indexed bam files
+        nreads (int): Number of reads sampled from the start of each bam file
+        nthreads (int): Number of bam files probed at once
+
+    Returns:
+        Dictionary. bam file -> list of read lengths found, most frequent first. More than one length means the bam is trimmed.
+
+    """
+    from multiprocessing.pool import ThreadPool
+
+    def probe(bamFile):
+        sidecar = bamFile + '.readlen'
+        # Tagged so sidecars holding aligned (clipped) lengths are probed again
+        stamp = "%d.full" % int(os.path.getmtime(bamFile))
+        try:
+            mtime, lengths = open(sidecar).read().strip().split("\t")
+            if mtime == stamp:
+                return map(int, lengths.split(","))
+        except (IOError, ValueError):
+            pass
+
+        import pysam
+        bam = pysam.Samfile(bamFile, 'rb')
+        lenToCount = {}
+        n = 0
+        for read in bam.fetch():
+            # Full read length: qlen leaves out soft-clipped bases
+            if hasattr(read, 'infer_read_length'):
+                readlen = read.infer_read_length() or read.query_length
+            else:
+                readlen = read.rlen
+            if not readlen:
+                continue
+            readlen = int(readlen)
+            lenToCount[readlen] = lenToCount.get(readlen, 0) + 1
+            n += 1
+            if n >= nreads:
+                break
+        bam.close()
+        lengths = sorted(lenToCount, key=lenToCount.get, reverse=True)
+
+        if len(lengths) > 0:
+            try:
+                out = open(sidecar, 'w')
+                out.write(stamp + "\t" + ",".join(map(str, lengths)) + "\n")
+                out.close()
+            except IOError:
+                pass
+        return lengths
+
+    if len(bamFiles) == 0:
+        return {}
+    pool = ThreadPool(min(int(nthreads), len(bamFiles)))
+    try:
+        lengths = pool.map(probe, bamFiles)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(bamFiles, lengths))
+
+
 def runMISOsingle(pickledDir, bamFile, readlen, overhanglen, outdir,\
-    paired_end, settings_f, scratchDir):
+    paired_end, settings_f, scratchDir, syncInterval=300):
     """ Function to run MISO on a single bam file.
 
     Args:
@@ -103,78 +179,70 @@ def runMISOsingle(pickledDir, bamFile, readlen, overhanglen, outdir,\
         paired_end (bool): Paired-End mode. Currently MISO cannot handle paired-end data, this flag defaults to <False>
         settings_f (str/path): This file contains a list of flags to provide the cluster to allow for ease of job submission
         scratchDir (str/path): Directory where MISO output will be stored.
+        syncInterval (int): Seconds between moving finished event files from <scratchDir> to <outdir> while MISO runs. <0> copies everything back at the end only
 
     Returns:
         Nothing. Generates a directory <outDir> where pickled MISO events and PSI values are stored.
 
     """
+    from misopy.settings import Settings
+    from misopy import run_events_analysis
+    # One walk of the annotation tree on shared storage, for both the run key and the cache entry
+    manifest = misoStage.manifestHash(pickledDir)
+    inputs, settings = misoCheckpoint.runKey(pickledDir, bamFile, readlen, \
+        overhanglen, paired_end, settings_f, manifest=manifest)
     if paired_end == 'False':
         paired_end = None
 
     t = str(time.time()) + str(random.random())
 
     print os.path.basename(pickledDir)
-    if not os.path.exists(scratchDir):
-        cmd = 'mkdir ' + scratchDir
-        process = subprocess.Popen(cmd, shell=True)
-        process.wait()
+    misoStage.makedirs(scratchDir)
  
-    # Copy pickled dir.
-    pickled = os.path.join(scratchDir, os.path.basename(pickledDir) + \
-        "." + t)
-    cmd = 'mkdir ' + pickled
-    process = subprocess.Popen(cmd, shell=True)
-    process.wait()
-    cmd = 'cp -r ' + pickledDir + '/* ' + pickled
-    process = subprocess.Popen(cmd, shell=True)
-    process.wait()
-
-    # Copy bam file. 
-    cmd = 'cp -fL ' + bamFile + ' ' + scratchDir
-    process = subprocess.Popen(cmd, shell=True)
-    process.wait()
-    cmd = 'cp -fL ' + bamFile + '.bai ' + scratchDir
-    process = subprocess.Popen(cmd, shell=True)
-    process.wait()
+    # Get pickled dir from the node-local cache, shared with other jobs on this node.
+    pickled, cacheToken = misoStage.acquireAnnotation(pickledDir, \
+        os.path.join(scratchDir, 'miso_annotation_cache'), key=manifest)
+
+    # Copy bam file and index.
     bam = os.path.join(scratchDir, os.path.basename(bamFile))
+    try:
+        misoStage.stage([[bamFile, bam], [bamFile + '.bai', bam + '.bai']])
+    except:
+        misoStage.releaseAnnotation(pickled, cacheToken)
+        raise
 
     # Give output directory in scratch a timestamp
     out = os.path.join(scratchDir, os.path.basename(outdir + "." + t))
 
     # LOAD SETTINGS FOR MISO
     Settings.load(settings_f)
+
+    # Move finished events back while the rest are computed
+    syncInterval = int(syncInterval)
+    if syncInterval > 0:
+        sync = misoStage.startSync(out, outdir, interval=syncInterval)
  
-    run_events_analysis.compute_all_genes_psi(\
-        pickled, bam, int(readlen), out, overhang_len=int(overhanglen),\
-        paired_end=paired_end, settings_fname=settings_f, prefilter=False)
+    try:
+        run_events_analysis.compute_all_genes_psi(\
+            pickled, bam, int(readlen), out, overhang_len=int(overhanglen),\
+            paired_end=paired_end, settings_fname=settings_f, prefilter=False)
+    finally:
+        misoStage.releaseAnnotation(pickled, cacheToken)
+        if syncInterval > 0:
+            misoStage.stopSync(sync)
 
     # Summarize sample
     #summary_fname = os.path.join(out, os.path.basename(outdir) + '.miso_summary') 
     #samples_utils.summarize_sampler_results(out, summary_fname)
 
-    if not os.path.exists(outdir):
-        cmd = 'mkdir -p ' + outdir
-        process = subprocess.Popen(cmd, shell=True)
-        process.wait()
-        
-    # Copy output back.
-    cmd = 'cp -r ' + out + '/* ' + outdir
-    process = subprocess.Popen(cmd, shell=True)
-    process.wait()
+    # Copy the rest of the output back.
+    misoStage.copyTree(out, outdir)
  
-    # Remove bam, output, and pickled dir. 
-    cmd = 'rm ' + bam
-    process = subprocess.Popen(cmd, shell=True)
-    process.wait()
-    cmd = 'rm ' + bam + '.bai'
-    process = subprocess.Popen(cmd, shell=True)
-    process.wait()
-    cmd = 'rm -fr ' + out
-    process = subprocess.Popen(cmd, shell=True)
-    process.wait()
-    cmd = 'rm -fr ' + pickled
-    process = subprocess.Popen(cmd, shell=True)
-    process.wait()
+    # Remove bam and output. The pickled dir stays in the node-local cache.
+    misoStage.removePath(bam)
+    misoStage.removePath(bam + '.bai')
+    misoStage.removePath(out)
+    misoCheckpoint.markSample(outdir, inputs, settings)
 
 # Run a single bam file with miso. Run locally, i.e. do not copy to a node.
 def runMISOlocal(pickledDir, bamFile, readlen, overhanglen, outdir,\
@@ -194,6 +262,12 @@ def runMISOlocal(pickledDir, bamFile, readlen, overhanglen, outdir,\
         Nothing. Generates a directory <outDir> where pickled MISO events and PSI values are stored.
 
     """
+    from misopy.settings import Settings
+    from misopy import run_events_analysis
+    # One walk of the annotation tree on shared storage, for both the run key and the cache entry
+    manifest = misoStage.manifestHash(pickledDir)
+    inputs, settings = misoCheckpoint.runKey(pickledDir, bamFile, readlen, \
+        overhanglen, paired_end, settings_f, manifest=manifest)
     if paired_end == False or paired_end == 'False':
         paired_end = None
     Settings.load(settings_f)
@@ -202,6 +276,7 @@ def runMISOlocal(pickledDir, bamFile, readlen, overhanglen, outdir,\
             pickledDir, bamFile, int(readlen), outdir,
             overhang_len=int(overhanglen),
             paired_end=paired_end, settings_fname=settings_f)
+    misoCheckpoint.markSample(outdir, inputs, settings)
 
 
 def compareMISO(eventDir, outDir, samples, usecluster=False):
@@ -214,7 +289,7 @@ def compareMISO(eventDir, outDir, samples, usecluster=False):
         usecluster (bool): If False, comparisons will be ran locally.
 
     Returns:
-        Nothing. Generates a comparison directory <outDir> where text files are saved containing Delta psi values for a given comparison
+        Nothing. Generates a comparison directory <outDir> where text files are saved containing Delta psi values for a given comparison. Comparisons whose completion marker matches the markers of both samples are skipped.
 
     """
     eventDir = os.path.abspath(os.path.expanduser(eventDir))
@@ -232,15 +307,26 @@ def compareMISO(eventDir, outDir, samples, usecluster=False):
         samples = samples.split(",") 
     for i in range(len(samples)):
         for j in range(i+1,len(samples)):
+            inputs = misoCheckpoint.dependencyKey(os.path.join(eventDir,samples[i]),\
+                os.path.join(eventDir,samples[j]))
+            if misoCheckpoint.isComplete(misoCheckpoint.comparisonMarker(outDir,\
+                samples[i], samples[j]), inputs, ''):
+                print 'Skipping completed', samples[i]+"_vs_"+samples[j]
+                continue
+
             cmd = 'python /home/et_wang/Tools/pythonmodules/lib/python2.7/site-packages/misopy/run_miso.py '+\
                 '--compare-samples '+os.path.join(eventDir,samples[i])+' '+\
                 os.path.join(eventDir,samples[j])+\
                 ' '+outDir
 
             if usecluster:
+                cmd = cmd + ' && python %s/script.py misoCheckpoint.markComparison %s %s %s %s'\
+                    %(sys.path[0], eventDir, outDir, samples[i], samples[j])
                 cmd = 'echo "'+cmd+'"' + "| qsub -q all.q " 
             print cmd
-            os.popen(cmd)
+            os.popen(cmd).read()
+            if not usecluster:
+                misoCheckpoint.markComparison(eventDir, outDir, samples[i], samples[j])
 
 
 def compute_meta_psi(eventDir, groups_f, outDir):
@@ -303,13 +389,98 @@ def compute_meta_psi(eventDir, groups_f, outDir):
                 print means, CIs, newpsi.mean(), newpsi.var()
 
 
-def summarize(indir, outdir, clustertype):
+def _readPosterior(miso_f):
+    """ Read a single MISO event file
+
+    Args:
+        miso_f (str/path): MISO event file. First line holds the event's isoforms, counts and coordinates, followed by sampled psi values
+
+    Returns:
+        Tuple. (header dictionary, array of sampled psi values of shape (samples, isoforms)), or None if the file holds no samples
+
+    """
+    f = open(miso_f)
+    info = dict([x.split("=", 1) for x in f.readline()[1:].strip().split("\t")])
+    f.readline()
+    psis = [line.split("\t", 1)[0] for line in f]
+    f.close()
+    if len(psis) == 0:
+        return None
+    niso = psis[0].count(",") + 1
+    return info, fromstring(",".join(psis), sep=",").reshape(len(psis), niso)
+
+
+def _summarizeChrom(chromDir):
+    import misoStats
+    events = []
+    infos = []
+    posteriors = []
+    for f in sorted(os.listdir(chromDir)):
+        if f.endswith(".miso"):
+            posterior = _readPosterior(os.path.join(chromDir, f))
+            if posterior is not None:
+                info, samples = posterior
+                # Two-isoform events are reported by the psi of the first isoform
+                if samples.shape[1] == 2:
+                    samples = samples[:, :1]
+                events.append(f[:-len(".miso")])
+                infos.append(info)
+                posteriors.append(samples)
+
+    lines = []
+    for event, info, stats in zip(events, infos, misoStats.posteriorStats(posteriors)):
+        low, high = stats['ci'][.95]
+        lines.append("\t".join([event] + [",".join(["%.2f" % x for x in v]) \
+            for v in [stats['mean'], low, high]] + \
+            [info.get('isoforms', 'NA').strip("[]"), info.get('counts', 'NA'), \
+             info.get('assigned_counts', 'NA'), info.get('chrom', 'NA'), \
+             info.get('strand', 'NA'), info.get('mRNA_starts', 'NA'), info.get('mRNA_ends', 'NA')]))
+    return lines
+
+
+def summarizeSample(samples_dir, summary_fname, nprocs=1):
+    """ Summarize the MISO output of a single sample in-process, without summarize_miso.py
+
+    Args:
+        samples_dir (str/path): MISO output directory of the sample
+        summary_fname (str/path): Summary file to be generated
+        nprocs (int): Number of chromosomes summarized at once
+
+    Returns:
+        Nothing. Generates a .miso_summary file with the posterior mean and 95% confidence interval of each event
+
+    """
+    chromDirs = [os.path.join(samples_dir, d) for d in sorted(os.listdir(samples_dir)) \
+        if os.path.isdir(os.path.join(samples_dir, d)) and d not in misoStage.SYNC_SKIP]
+    nprocs = int(nprocs)
+    if nprocs > 1:
+        from multiprocessing import Pool
+        pool = Pool(nprocs)
+        chromLines = pool.map(_summarizeChrom, chromDirs)
+        pool.close()
+        pool.join()
+    else:
+        chromLines = map(_summarizeChrom, chromDirs)
+
+    tmp = summary_fname + '.tmp.%d' % os.getpid()
+    out = open(tmp, 'w')
+    out.write("\t".join(["event_name", "miso_posterior_mean", "ci_low", "ci_high", \
+        "isoforms", "counts", "assigned_counts", "chrom", "strand", \
+        "mRNA_starts", "mRNA_ends"]) + "\n")
+    for lines in chromLines:
+        out.writelines([line + "\n" for line in lines])
+    out.close()
+    os.rename(tmp, summary_fname)
+
+
+def summarize(indir, outdir, clustertype, nprocs=1):
     """ Summarize miso output using summarize-samples indir is a directory that contains all the miso directories
 
     Args:
         indir (str/path): Directory pointing towards directory containing pickled MISO results for each sample
         outDir (str/path): Directory where MISO summary results will be stored
-        clustertype (str): <sge/torque> Type of cluster
+        clustertype (str): <sge/torque> Type of cluster, or <local> to summarize in this process
+        nprocs (int): Number of chromosomes summarized at once in <local> mode
 
     Description:
         # Function to summarize a comparison between two samples.
@@ -335,17 +506,27 @@ def summarize(indir, outdir, clustertype):
         # 19. description
 
     Returns:
-        Nothing. Generates text file summarizing MISO results for each sample
+        Nothing. Generates text file summarizing MISO results for each sample. Samples whose summary completion marker matches the sample's marker are skipped.
 
     """
+    import Mypbm, Mysge
     if not os.path.exists(outdir):
         os.mkdir(os.path.abspath(outdir)) 
     misodirs = os.listdir(indir)
     for d in misodirs:
         samples_dir = os.path.abspath(os.path.join(indir, d))
         summary_fname = os.path.abspath(os.path.join(outdir, d + '.miso_summary')) 
-        if not os.path.exists(summary_fname):
+        if not os.path.exists(summary_fname) or not misoCheckpoint.isComplete(\
+            misoCheckpoint.summaryMarker(samples_dir), \
+            misoCheckpoint.dependencyKey(samples_dir), summary_fname):
+            if clustertype == 'local':
+                print 'Summarizing', d
+                summarizeSample(samples_dir, summary_fname, nprocs)
+                misoCheckpoint.markSummary(samples_dir, summary_fname)
+                continue
             cmd = 'python summarize_miso.py --summarize-samples %s %s'%(samples_dir, summary_fname)
+            cmd += ' && python %s/script.py misoCheckpoint.markSummary %s %s'\
+                %(sys.path[0], samples_dir, summary_fname)
             print 'Running', cmd
             scriptOptions = {'ppn':1, 'jobname':'summarize_miso' + d[:3]}
             if clustertype == 'torque':
@@ -355,57 +536,81 @@ def summarize(indir, outdir, clustertype):
             time.sleep(1)
 
 
-def summarizeVs(indir, ensGeneMap_f, outdir):
+# Event annotation shared with forked summarizeVs workers
+_eventInfo = {}
+
+
+def _summarizeVsOne(args):
+    """ Summarize a single MISO comparison directory, annotating events from _eventInfo """
+    indir, dir, outdir = args
+    fname = os.path.basename(dir)
+    sample1, sample2 = fname.split("_vs_")
+    bf_f = os.path.join(indir,dir,'bayes-factors',fname+".miso_bf")
+
+    lines = [line.strip() for line in open(bf_f) if not line.startswith("event_name")]
+
+    # Max bayes factor over the comma separated isoform fields of every event at once
+    bfs = [line.split("\t", 9)[8] for line in lines]
+    maxbf = zeros(len(bfs))
+    if len(bfs) > 0:
+        nfields = array([bf.count(",") + 1 for bf in bfs])
+        flat = array(",".join(bfs).split(","), dtype=float)
+        maxbf = maximum.reduceat(flat, concatenate(([0], cumsum(nfields)[:-1])))
+    # Stable descending order, as sorting the rows with reverse=True
+    order = argsort(-maxbf, kind='mergesort')
+    maxbf = maxbf.tolist()
+    
+    out = open(os.path.join(outdir,fname+".miso_bf"),'w')
+    out.write("\t".join(["#event_name",\
+        sample1+"_posterior_mean",sample1+"_ci_low",sample1+"_ci_high",\
+        sample2+"_posterior_mean",sample2+"_ci_low",sample2+"_ci_high",\
+        "diff","bayes_factor","isoforms",\
+        sample1+"_counts",sample1+"_assigned_counts",\
+        sample2+"_counts",sample2+"_assigned_counts", "chrom", "strand",\
+        "mRNA_starts", "mRNA_ends", "max_bf"])+"\n")
+
+    infos = misoAnnotation.lookupEventInfo(_eventInfo, \
+        [lines[i].split("\t", 1)[0] for i in order])
+    out.writelines(["%s\t%s\t%s\n" % (lines[i], str(maxbf[i]), "\t".join(info)) \
+        for i, info in zip(order, infos)])
+    out.close() 
+    return dir
+
+
+def summarizeVs(indir, ensGeneMap_f, outdir, nprocs=1):
     """ Summarize MISO comparison output
 
     Args:
         indir (str/path): Directory pointing towards directory containing MISO comparison text files
-        ensGeneMap_f (map/db): Pickled MISO annotation database. Database is a shelved dictionary associating event <key> to [geneID, Gene symbol, gene description] <value>
+        ensGeneMap_f (map/db): MISO annotation database from storeEventToInfo, or a shelved dictionary associating event <key> to [geneID, Gene symbol, gene description] <value>
         outDir (str/path): Directory where MISO summary results will be stored
+        nprocs (int): Number of comparisons summarized at once, or <all> for one per processor. Worker processes share the annotation loaded by the parent.
 
     Returns:
         Nothing. Generates text file summarizing MISO comparison results for each comparison
 
     """
-    eventToInfo = shelve.open(ensGeneMap_f, 'r') 
+    global _eventInfo
+    _eventInfo = misoAnnotation.loadEventInfo(ensGeneMap_f)
+    print len(_eventInfo), 'annotated events'
  
     dirs = [f for f in os.listdir(indir) if "_vs_" in f]
-    for dir in dirs:
-        print dir
-        fname = os.path.basename(dir)
-        sample1, sample2 = fname.split("_vs_")
-        bf_f = os.path.join(indir,dir,'bayes-factors',fname+".miso_bf")
-
-        data = []
-        for line in open(bf_f):
-            if not line.startswith("event_name"):
-                vals = line.strip().split("\t")
-                bf = vals[8]
-                if ',' in bf:
-                    maxbf = max(map(float,bf.split(",")))
-                else:
-                    maxbf = float(bf)
-                vals.append(maxbf)
-                data.append(vals)
-        data.sort(key=operator.itemgetter(-1),reverse=True)
-        
-        out = open(os.path.join(outdir,fname+".miso_bf"),'w')
-        out.write("\t".join(["#event_name",\
-            sample1+"_posterior_mean",sample1+"_ci_low",sample1+"_ci_high",\
-            sample2+"_posterior_mean",sample2+"_ci_low",sample2+"_ci_high",\
-            "diff","bayes_factor","isoforms",\
-            sample1+"_counts",sample1+"_assigned_counts",\
-            sample2+"_counts",sample2+"_assigned_counts", "chrom", "strand",\
-            "mRNA_starts", "mRNA_ends", "max_bf"])+"\n")
-
-        for item in data:
-            event = item[0]
-            try:
-                item.extend(eventToInfo[item[0]])
-            except: 
-                item.extend(["n/a","n/a","n/a"])
-            out.write("\t".join(map(str,item))+"\n")
-        out.close() 
+    tasks = [(indir, dir, outdir) for dir in dirs]
+    if nprocs == 'all':
+        import multiprocessing
+        nprocs = multiprocessing.cpu_count()
+    nprocs = int(nprocs)
+    if nprocs > 1:
+        from multiprocessing import Pool
+        # Fork after loading the annotation so workers inherit it
+        pool = Pool(nprocs)
+        for dir in pool.imap_unordered(_summarizeVsOne, tasks, chunksize=4):
+            print dir
+        pool.close()
+        pool.join()
+    else:
+        for task in tasks:
+            print _summarizeVsOne(task)
 
 
 
@@ -501,7 +706,7 @@ def shelveEventToInfo(txt_f, db_f):
         Database. Generates a shelved dictionary db[event] = [gene, symb, desc]
 
     """
-    db = shelve.open(db_f, writeback=True)
+    db = shelve.open(db_f)
     for line in open(txt_f):         
         if not line.startswith("#"):
             event, gene, symb, desc = line.strip().split("\t")
@@ -509,6 +714,20 @@ def shelveEventToInfo(txt_f, db_f):
     db.close()
 
 
+def storeEventToInfo(txt_f, db_f):
+    """ Utility function to bulk load the ensGene.map or locuslink.map files from Gene description file into an annotation store. Replaces shelveEventToInfo for summarizeVs, consolidateSummariesNoBF and psiTableFromPsiFiles.
+
+    Args:
+        txt_f (str/path): Directory/path to Gene description file
+        db_f (str): Name of Database to be generated
+
+    Returns:
+        Database. Generates a sqlite database db[event] = [gene, symb, desc]
+
+    """
+    misoAnnotation.buildEventInfo(txt_f, db_f)
+
+
 
 def consolidateSummaries(summarydir, groups_f, out_f):
     """ Consolidate all single isoform summary information into 1 file for subsequent analysis and plotting.
@@ -623,7 +842,7 @@ def consolidateSummariesMultiIso(summarydir, groups_f, out_f):
     groups = groupToSamples.keys()
     print len(samples), 'samples'
     # Iterate through all samples and save psi values
-	eventMaster = {}    # event -> sample -> psi values and bfs
+    eventMaster = {}    # event -> sample -> psi values and bfs
     for s in samples:
         try:
             print s
@@ -695,8 +914,6 @@ def consolidateSummariesMultiIso(summarydir, groups_f, out_f):
         except:
             out.write("n/a\tn/a\tn/a\n")
     out.close()
-    except:
-        print e, samples[i],samples[j]
 
 
 def monotonic(consolidated_f, groups_f, minbf, nshuffles, out_f):
@@ -1021,7 +1238,7 @@ def consolidateSummariesNoBF(summarydir, eventToGeneInfo_f, out_f):
 
     Args:
         summarydir (str/path): Directory containing MISO summary files
-        eventToGeneInfo_f (dict/database): A shelved dictionary db[event] = [gene, symb, desc]
+        eventToGeneInfo_f (dict/database): Annotation database from storeEventToInfo, or a shelved dictionary db[event] = [gene, symb, desc]
         out_f (str): Name of Consolidated summary file to be generated
 
     Returns:
@@ -1029,7 +1246,7 @@ def consolidateSummariesNoBF(summarydir, eventToGeneInfo_f, out_f):
 
     """
     import miso_utils
-    eventToGeneInfo = shelve.open(eventToGeneInfo_f, 'r') 
+    eventToGeneInfo = misoAnnotation.openEventInfo(eventToGeneInfo_f)
      
     samples = [s.split(".")[0] for s in os.listdir(summarydir)]
     samples.sort()
@@ -1052,17 +1269,16 @@ def consolidateSummariesNoBF(summarydir, eventToGeneInfo_f, out_f):
         out.write("%s\t%s\t%s\t"%(samples[i] + "_low", samples[i] + "_mean",\
             samples[i] + "_high"))
     out.write("gene\tsymb\tdesc\n")
-    for e in eventMaster:
+    events = eventMaster.keys()
+    infos = misoAnnotation.lookupEventInfo(eventToGeneInfo, events)
+    for e, info in zip(events, infos):
         out.write(e + "\t")
         for i in range(len(samples)):
             if samples[i] in eventMaster[e]:
                 out.write("\t".join(map(str, eventMaster[e][samples[i]])) + "\t")
             else:
                 out.write("n/a\tn/a\tn/a\t")
-        try:
-            out.write("\t".join(eventToGeneInfo[e]) + "\n")
-        except:
-            out.write("n/a\tna/a\tn/a\n")
+        out.write("\t".join(info) + "\n")
     out.close()
 
 
@@ -1,4 +1,7 @@
-import os, sys, operator, re, glob, subprocess, shelve
+import os, sys, operator, glob, subprocess
+import misoStats
+import matplotlib
+matplotlib.use('Agg')   # figures are only written to files; skip interactive backends
 from pylab import *
 
 params = {'axes.labelsize': 10,
@@ -8,6 +11,12 @@ params = {'axes.labelsize': 10,
           'ytick.labelsize': 8}
 rcParams.update(params)
 
+# Scatter layers with at least this many points are drawn as images in vector figures
+RASTERIZE_MIN = 10000
+
+# Scatter plots with at least this many background points draw them as a density image
+DENSITY_MIN = 100000
+
 
 def plotPosterior(miso_f, resolution):
     """Generates a histogram of posterior means from MISO summary file
@@ -27,21 +36,16 @@ def plotPosterior(miso_f, resolution):
             psi, logodds = line.strip().split("\t")
             psis.append(float(psi.split(",")[0]))
 
-    ci = .95
-    alpha = 1 - ci
-    lidx = int(round((alpha / 2) * len(psis)) - 1)
-    # the upper bound is the (1-alpha/2)*n nth smallest sample, where n is
-    # the number of samples
-    hidx = int(round((1 - alpha / 2) * len(psis)) - 1)
-    psis.sort()
-    clow, chigh = [psis[lidx], psis[hidx]]
+    stats = misoStats.posteriorStats([psis])[0]
+    clow, chigh = [stats['ci'][.95][0][0], stats['ci'][.95][1][0]]
+    psimedian = stats['median'][0]
 
     hist(psis, linspace(0, 1, resolution), normed=True, facecolor='k', \
          edgecolor='w')
     axvline(clow, linestyle='--', color='#CCCCCC')
     axvline(chigh, linestyle='--', color='#CCCCCC')
-    axvline(median(psis), color='r')
-    text(.95, 14, "$\Psi$ = %.2f\n$\Psi_{low}$ = %.2f\n$\Psi_{high}$ = %.2f" % (median(psis), \
+    axvline(psimedian, color='r')
+    text(.95, 14, "$\Psi$ = %.2f\n$\Psi_{low}$ = %.2f\n$\Psi_{high}$ = %.2f" % (psimedian, \
                                                                                 clow, chigh), fontsize=6, va='top',
          ha='right')
 
@@ -99,7 +103,7 @@ def getSummarySingle(summary_f):
                 isoforms = vals[4]
                 s1c = vals[5]
                 s1ac = vals[6]
-                s1ac = sum([int(x.split(":")[1]) for x in s1ac.split(",")])
+                s1ac = parseAssignedCounts(s1ac)
                 chrom = vals[7]
                 strand = vals[8]
                 starts = vals[9]
@@ -152,10 +156,10 @@ def getSummary(summary_f):
                 isoforms = vals[9]
                 s1c = vals[10]
                 s1ac = vals[11]
-                s1ac = sum([int(x.split(":")[1]) for x in s1ac.split(",")])
+                s1ac = parseAssignedCounts(s1ac)
                 s2c = vals[12]
                 s2ac = vals[13]
-                s2ac = sum([int(x.split(":")[1]) for x in s2ac.split(",")])
+                s2ac = parseAssignedCounts(s2ac)
                 maxbf = vals[18]
                 gene = vals[19]
                 symb = vals[20]
@@ -191,20 +195,67 @@ def parseCounts(countsfield):
     """Helper function to parse counts field.
 
     Args:
-        countsfield (slice): column of MISO summary file containing countsfield
+        countsfield (slice): column of MISO summary file containing countsfield, i.e. (0,1):12,(1,0):3
 
     Returns:
        Total number of counts for a given event
 
     """
     cttot = 0
-    iterator = re.finditer("\(.+?\)\:[0-9]+", countsfield)
-    for item in iterator:
-        isoform, ct = countsfield[item.start(): item.end()].split(":")
-        cttot += int(ct)
+    # Each "):" closes a read class; its count runs up to the next comma
+    for item in countsfield.split("):")[1:]:
+        ct = item.split(",", 1)[0]
+        if ct.isdigit():
+            cttot += int(ct)
     return cttot
 
 
+def parseCountsColumn(countsfields, classes=False):
+    """Parse a whole column of counts fields at once.
+
+    Args:
+        countsfields (list): counts fields of a MISO summary file, one per event
+        classes (bool): Also return the counts of each read class
+
+    Returns:
+       Array of total counts per event. With <classes>, a tuple (totals, read class labels, matrix of counts with one row per event and one column per read class)
+
+    """
+    if not classes:
+        return array([parseCounts(f) for f in countsfields], dtype=int)
+
+    classToCol = {}
+    entries = []
+    for i in range(len(countsfields)):
+        items = countsfields[i].split("):")
+        for j in range(1, len(items)):
+            ct = items[j].split(",", 1)[0]
+            if ct.isdigit():
+                label = items[j - 1].rsplit("(", 1)[-1]
+                col = classToCol.setdefault("(" + label + ")", len(classToCol))
+                entries.append((i, col, int(ct)))
+
+    labels = sorted(classToCol, key=classToCol.get)
+    matrix = zeros((len(countsfields), len(labels)), dtype=int)
+    if len(entries) > 0:
+        entries = array(entries)
+        add.at(matrix, (entries[:, 0], entries[:, 1]), entries[:, 2])
+    return matrix.sum(axis=1), labels, matrix
+
+
+def parseAssignedCounts(assignedfield):
+    """Helper function to parse assigned counts field, i.e. 0:12,1:3
+
+    Args:
+        assignedfield (slice): column of MISO summary file containing assigned counts
+
+    Returns:
+       Total number of reads assigned to isoforms for a given event
+
+    """
+    return sum([int(x.split(":")[1]) for x in assignedfield.split(",")])
+
+
 def plotDistributions(bf_f, out_f):
     """Generates a density map of bayes factor distributions
 
@@ -225,29 +276,28 @@ def plotDistributions(bf_f, out_f):
     mins = [0, 0, -1, -1, 0, 0]
     maxs = [1, 1, 1, 2, 5, 5]
 
+    # One column per field, and which events are in range for it, computed once
+    columns = []
+    inrange = []
+    for i in range(len(fields)):
+        if islist[i]:
+            vals = array([eventToInfo[e][fields[i]][0] for e in eventToInfo], dtype=float)
+        else:
+            vals = array([eventToInfo[e][fields[i]] for e in eventToInfo], dtype=float)
+        if logged[i]:
+            vals = log10(vals + 1)
+        columns.append(vals)
+        inrange.append((vals >= mins[i]) & (vals <= maxs[i]))
+
     figure(figsize=(11, 14))
     n = 1
     for i in range(len(fields)):
         for j in range(len(fields)):
             subplot(len(fields), len(fields), n)
 
-            if islist[i]:
-                xvals = array([eventToInfo[e][fields[i]][0] for e in eventToInfo])
-            else:
-                xvals = array([eventToInfo[e][fields[i]] for e in eventToInfo])
-            if islist[j]:
-                yvals = array([eventToInfo[e][fields[j]][0] for e in eventToInfo])
-            else:
-                yvals = array([eventToInfo[e][fields[j]] for e in eventToInfo])
-            if logged[i]:
-                xvals = log10(xvals + 1)
-            if logged[j]:
-                yvals = log10(yvals + 1)
-            xidx = where((xvals >= mins[i]) & (xvals <= maxs[i]))[0]
-            yidx = where((yvals >= mins[j]) & (yvals <= maxs[j]))[0]
-            idx = array([k for k in xidx if k in yidx])
-            xvals = xvals[idx]
-            yvals = yvals[idx]
+            idx = inrange[i] & inrange[j]
+            xvals = columns[i][idx]
+            yvals = columns[j][idx]
 
             hexbin(xvals, yvals, bins='log')
 
@@ -290,13 +340,50 @@ def countSigEvents(settings_f):
     print len(allEvents)
 
 
-def psi1_vs_psi2_v1(psi1_f, psi2_f, out_f):
+def spreadEnvelope(psi1, psi2, nbins=29):
+    """Envelope of the spread of psi values around the diagonal, drawn behind psi scatter plots
+
+    Args:
+        psi1 (array): psi values of sample one
+        psi2 (array): psi values of sample two
+        nbins (int): Number of bins along the diagonal
+
+    Returns:
+       Array. Polygon vertices, one standard deviation of the distance from the diagonal on either side of it, per bin
+
+    """
+    nbins = int(nbins)
+    a = pi / 4.
+    R = array([[cos(a), -sin(a)], [sin(a), cos(a)]])
+    rotated = dot(vstack((psi1, psi2)).T, R)
+    xvals = linspace(0, sqrt(2), nbins + 1)
+    centres = (xvals[:-1] + xvals[1:]) / 2
+
+    # One pass assigns every point its bin; the last bin includes its right edge
+    inside = (rotated[:, 0] >= xvals[0]) & (rotated[:, 0] <= xvals[-1])
+    bins = minimum(digitize(rotated[inside, 0], xvals) - 1, nbins - 1)
+    y = rotated[inside, 1]
+    n = bincount(bins, minlength=nbins).astype(float)
+    with errstate(divide='ignore', invalid='ignore'):
+        means = bincount(bins, y, minlength=nbins) / n
+        spread = sqrt(bincount(bins, (y - means[bins]) ** 2, minlength=nbins) / n)
+
+    plusspread = vstack((centres, spread)).T
+    minusspread = vstack((centres, -spread)).T[::-1]
+
+    a = -pi / 4.
+    R = array([[cos(a), -sin(a)], [sin(a), cos(a)]])
+    return vstack((dot(plusspread, R), dot(minusspread, R)))
+
+
+def psi1_vs_psi2_v1(psi1_f, psi2_f, out_f, nbins=29):
     """Generate a scatter plot of psi values for two samples
 
     Args:
         psi1_f (str/path): MISO summary file
         psi2_f (str/path): MISO summary file
         out_f (str): Label for figure
+        nbins (int): Number of bins of the spread envelope
 
     Returns:
        Nothing. Generates a scatter plot of psi values for two samples
@@ -315,26 +402,7 @@ def psi1_vs_psi2_v1(psi1_f, psi2_f, out_f):
     print data.shape
 
     figure(figsize=(6, 6))
-    a = pi / 4.
-    R = array([[cos(a), -sin(a)], [sin(a), cos(a)]])
-    rotated = dot(vstack((data[:, 0], data[:, 1])).T, R)
-    xvals = linspace(0, sqrt(2), 30)
-    plusspread = []
-    minusspread = []
-    for x in range(len(xvals) - 1):
-        idx = where((rotated[:, 0] >= xvals[x]) & \
-                    (rotated[:, 0] <= xvals[x + 1]))[0]
-        plusspread.append([xvals[x:x + 2].mean(), rotated[idx, 1].std()])
-        minusspread.insert(0, [xvals[x:x + 2].mean(), -rotated[idx, 1].std()])
-
-    plusspread = array(plusspread)
-    minusspread = array(minusspread)
-
-    a = -pi / 4.
-    R = array([[cos(a), -sin(a)], [sin(a), cos(a)]])
-    plusrotated = dot(plusspread, R)
-    minusrotated = dot(minusspread, R)
-    allrotated = vstack((plusrotated, minusrotated))
+    allrotated = spreadEnvelope(data[:, 0], data[:, 1], nbins)
 
     fill(allrotated[:, 0], allrotated[:, 1], color='#EEEEEE', zorder=0)
 
@@ -350,7 +418,8 @@ def psi1_vs_psi2_v1(psi1_f, psi2_f, out_f):
     savefig(out_f)
 
 
-def psi1_vs_psi2(bf1_f, bf2_f, idx1, idx2, label1, label2, out_f=False):
+def psi1_vs_psi2(bf1_f, bf2_f, idx1, idx2, label1, label2, out_f=False, nbins=29, \
+                 density='auto', densitybins=200):
     """Generate a scatter plot of psi values for two samples
 
     Args:
@@ -361,6 +430,9 @@ def psi1_vs_psi2(bf1_f, bf2_f, idx1, idx2, label1, label2, out_f=False):
         label1 (str): Sample 1 label
         label2 (str): Sample 2 label
         out_f (bool): Label for figure
+        nbins (int): Number of bins of the spread envelope
+        density (str): Draw psi values as a density image: True, False, or auto to do so from DENSITY_MIN events
+        densitybins (int): Number of density image bins along each axis
 
     Returns:
        Nothing. Generates a scatter plot of psi values for two samples or prints the correlation coefficient between the psi values for the two samples
@@ -382,30 +454,14 @@ def psi1_vs_psi2(bf1_f, bf2_f, idx1, idx2, label1, label2, out_f=False):
     print data.shape
 
     figure(figsize=(6, 6))
-    a = pi / 4.
-    R = array([[cos(a), -sin(a)], [sin(a), cos(a)]])
-    rotated = dot(vstack((data[:, 0], data[:, 1])).T, R)
-    xvals = linspace(0, sqrt(2), 30)
-    plusspread = []
-    minusspread = []
-    for x in range(len(xvals) - 1):
-        idx = where((rotated[:, 0] >= xvals[x]) & \
-                    (rotated[:, 0] <= xvals[x + 1]))[0]
-        plusspread.append([xvals[x:x + 2].mean(), rotated[idx, 1].std()])
-        minusspread.insert(0, [xvals[x:x + 2].mean(), -rotated[idx, 1].std()])
-
-    plusspread = array(plusspread)
-    minusspread = array(minusspread)
-
-    a = -pi / 4.
-    R = array([[cos(a), -sin(a)], [sin(a), cos(a)]])
-    plusrotated = dot(plusspread, R)
-    minusrotated = dot(minusspread, R)
-    allrotated = vstack((plusrotated, minusrotated))
+    allrotated = spreadEnvelope(data[:, 0], data[:, 1], nbins)
 
     fill(allrotated[:, 0], allrotated[:, 1], color='#EEEEEE', zorder=0)
 
-    scatter(data[:, 0], data[:, 1], s=1, color='k', alpha=.5)
+    if useDensity(density, data.shape[0]):
+        densityImage(data[:, 0], data[:, 1], densitybins)
+    else:
+        scatter(data[:, 0], data[:, 1], s=1, color='k', alpha=.5)
 
     xlim(-.1, 1.1)
     ylim(-.1, 1.1)
@@ -420,59 +476,111 @@ def psi1_vs_psi2(bf1_f, bf2_f, idx1, idx2, label1, label2, out_f=False):
         return corrcoef(data[:, 0], data[:, 1])[0][1]
 
 
-def plotAsymptote(bf_f, outdir):
+def asymptoteWindows(logcts, bfs, window=100, stride=100, min_bf=[5]):
+    """Fraction of significant events in sliding windows of events ordered by read coverage.
+
+    Args:
+        logcts (array): log10 read counts of each event
+        bfs (array): max bayes factor of each event
+        window (int): Number of events on either side of a window's centre
+        stride (int): Number of events between window centres
+        min_bf (list): Bayes factor thresholds for an event to be significant
+
+    Returns:
+       Tuple. (mean log10 counts of each window, matrix of fractions of significant events with one row per window and one column per threshold)
+
+    """
+    order = argsort(logcts, kind='mergesort')
+    logcts = asarray(logcts, dtype=float)[order]
+    bfs = asarray(bfs, dtype=float)[order]
+    n = len(logcts)
+
+    # Window sums are differences of running sums, so every window costs O(1)
+    xsum = concatenate([[0], cumsum(logcts)])
+    sig = bfs[:, newaxis] >= array(min_bf, dtype=float)[newaxis, :]
+    sigsum = concatenate([zeros((1, sig.shape[1]), dtype=int), cumsum(sig, axis=0)])
+
+    centres = arange(0, n, stride)
+    starts = maximum(0, centres - window)
+    ends = minimum(n - 1, centres + window)
+    size = (ends - starts).astype(float)
+    with errstate(divide='ignore', invalid='ignore'):
+        xvals = (xsum[ends] - xsum[starts]) / size
+        yvals = (sigsum[ends] - sigsum[starts]) / size[:, newaxis]
+    return xvals, yvals
+
+
+def _saturation(x, a, b, c):
+    return a / (1 + exp(-b * (x - c)))
+
+
+def plotAsymptote(bf_f, outdir, window=100, stride=100, min_bf=5, fit=False):
     """Plot number of significant events vs. read coverage. Estimate asymptote.
 
     Args:
         bf_f (str/path): MISO bayes factor file
         outdir (str/path): Directory in which the asymptote figure will be saved
+        window (int): Number of events on either side of each point
+        stride (int): Number of events between points
+        min_bf (str): Bayes factor threshold, or comma delimited thresholds plotted together, i.e. 5,10,20
+        fit (bool): Fit a logistic curve to each threshold's points (needs scipy) and report its asymptote
 
     Returns:
-       Nothing. Generates a line graph depicting significant events vs. read coverage for two samples
+       Nothing. Generates a line graph depicting significant events vs. read coverage for two samples, and a table of the plotted points <bf_f>.asymptote.txt
 
     """
+    window = int(window)
+    stride = int(stride)
+    thresholds = [float(x) for x in str(min_bf).split(",")]
+
     print "Getting BF info."
     eventToInfo, header = getSummary(bf_f)
 
-    data = []
-    for event in eventToInfo:
-        bf = eventToInfo[event]['bayes factor']
-        s1c = eventToInfo[event]['sample 1 counts']
-        s2c = eventToInfo[event]['sample 2 counts']
-
-        ct1 = 0
-        iterator = re.finditer("\(.+?\)\:[0-9]+", s1c)
-        for item in iterator:
-            isoform, ct = s1c[item.start(): item.end()].split(":")
-            ct1 += int(ct)
-
-        ct2 = 0
-        iterator = re.finditer("\(.+?\)\:[0-9]+", s2c)
-        for item in iterator:
-            isoform, ct = s2c[item.start(): item.end()].split(":")
-            ct2 += int(ct)
-
-        data.append([log10(ct1 + ct2), max(bf)])
+    events = eventToInfo.keys()
+    ct1 = parseCountsColumn([eventToInfo[event]['sample 1 counts'] for event in events])
+    ct2 = parseCountsColumn([eventToInfo[event]['sample 2 counts'] for event in events])
+    bfs = [max(eventToInfo[event]['bayes factor']) for event in events]
 
     print "Processing."
-    data.sort(key=operator.itemgetter(0))
-    data = array(data)
-    binres = 100
-    min_bf = 5
+    xvals, yvals = asymptoteWindows(log10(ct1 + ct2), bfs, window, stride, thresholds)
 
-    plotdata = []
-    for i in range(data.shape[0]):
-        if i % binres == 0:
-            window = arange(max([0, i - binres]), \
-                            min([data.shape[0] - 1, i + binres]))
-            xval = mean(data[window, 0])
-            yval = len(where(data[window, 1] >= min_bf)[0]) / \
-                   float(len(window))
-            plotdata.append([xval, yval])
+    out_f = os.path.join(outdir, os.path.basename(bf_f) + ".asymptote")
+    out = open(out_f + ".txt", 'w')
+    out.write("#log10_counts\t" + "\t".join(["min_bf_%g" % t for t in thresholds]) + "\n")
+    for i in range(len(xvals)):
+        out.write("%f\t" % xvals[i] + "\t".join(["%f" % y for y in yvals[i]]) + "\n")
+    out.close()
 
-    plotdata = array(plotdata, dtype='f')
-    plot(plotdata[:, 0], plotdata[:, 1], 'k.')
-    savefig(os.path.join(outdir, os.path.basename(bf_f) + ".asymptote.pdf"))
+    figure()
+    colors = ['k', 'r', 'b', 'g', 'm', 'c']
+    for j in range(len(thresholds)):
+        color = colors[j % len(colors)]
+        plot(xvals, yvals[:, j], color + '.', label="BF >= %g" % thresholds[j])
+        if fit is not False and fit != 'False':
+            try:
+                from scipy.optimize import curve_fit
+            except ImportError:
+                print "scipy is not installed, skipping fit."
+                fit = False
+                continue
+            ok = isfinite(xvals) & isfinite(yvals[:, j])
+            try:
+                params, cov = curve_fit(_saturation, xvals[ok], yvals[ok, j], \
+                                        p0=[yvals[ok, j].max(), 1, median(xvals[ok])], \
+                                        bounds=([0, 0, -inf], [1, inf, inf]))
+            except (RuntimeError, TypeError, ValueError), e:
+                print "Fit failed for BF >=", thresholds[j], e
+                continue
+            print "BF >= %g: asymptote %.4f, half-maximum at log10 counts %.2f" % \
+                  (thresholds[j], params[0], params[2])
+            xfit = linspace(xvals[ok].min(), xvals[ok].max(), 200)
+            plot(xfit, _saturation(xfit, *params), color + '-')
+    if len(thresholds) > 1:
+        legend(loc='lower right')
+    xlabel("log10 counts")
+    ylabel("Fraction of events with BF >= min_bf")
+    savefig(out_f + ".pdf")
+    close()
 
 
 def psiFromPosteriors(posteriorDir, outDir):
@@ -500,6 +608,8 @@ def psiFromPosteriors(posteriorDir, outDir):
                 print chrom
                 chromDir = os.path.join(sampleDir, chrom)
                 files = os.listdir(chromDir)
+                enames = []
+                posteriors = []
                 for f in files:
                     ename = f.split(".")[0]
                     fname = os.path.join(chromDir, f)
@@ -507,14 +617,18 @@ def psiFromPosteriors(posteriorDir, outDir):
                     psivals = []
                     for line in open(fname):
                         if i > 1:
-                            psis, score = line.strip().split()
-                            psi = float(psis.split(",")[0])
-                            psivals.append(psi)
+                            psivals.append(line.split(None, 1)[0].split(",", 1)[0])
                         i += 1
 
                     if len(psivals) > 100:
-                        out.write("\t".join(map(str, [ename, mean(psivals), \
-                                                      std(psivals), len(psivals)])) + "\n")
+                        enames.append(ename)
+                        posteriors.append(array(psivals, dtype=float))
+
+                # Stats of all events in the chromosome in one batch
+                for ename, posterior, stats in zip(enames, posteriors, \
+                                                  misoStats.posteriorStats(posteriors, [])):
+                    out.write("\t".join(map(str, [ename, stats['mean'][0], \
+                                                  stats['std'][0], len(posterior)])) + "\n")
 
     out.close()
 
@@ -525,14 +639,15 @@ def psiTableFromPsiFiles(psiDir, order_f, lookup_f, out_f):
     Args:
         psiDir (str/path): MISO summary directory
         order_f (str/path): File containing one sample per line. The order of this file will dictate the order of the out_f
-        lookup_f (dict): This is a pickled map file for the annotation set of events i.e. ALE, AFE, TandemUTR etc.
+        lookup_f (dict): This is an annotation store (misoWrapper.storeEventToInfo) or pickled map file for the annotation set of events i.e. ALE, AFE, TandemUTR etc.
         out_f (str/path): Directory in which the table of psi values will be written to.
 
     Returns:
        Nothing. Generates a text file containing psi values.
 
     """
-    eventToInfo = shelve.open(lookup_f, 'r')
+    import misoAnnotation
+    eventToInfo = misoAnnotation.openEventInfo(lookup_f)
 
     eventToPsi = {}
     samples = []
@@ -550,7 +665,9 @@ def psiTableFromPsiFiles(psiDir, order_f, lookup_f, out_f):
     out = open(out_f, 'w')
     out.write("#Event\t")
     out.write("\t".join(samples) + "\n")
-    for event in eventToPsi:
+    events = eventToPsi.keys()
+    infos = misoAnnotation.lookupEventInfo(eventToInfo, events)
+    for event, info in zip(events, infos):
         out.write(event + "\t")
         psimeans = []
         for sample in samples:
@@ -558,10 +675,7 @@ def psiTableFromPsiFiles(psiDir, order_f, lookup_f, out_f):
                 psimeans.append(str(round(eventToPsi[event][sample], 2)))
             else:
                 psimeans.append('n/a')
-        if event in eventToInfo:
-            gene, symb, desc = eventToInfo[event]
-        else:
-            gene, symb, desc = ['n/a', 'n/a', 'n/a']
+        gene, symb, desc = info
         out.write("\t".join(psimeans) + "\t")
         out.write(gene + "\t" + symb + "\t" + desc + "\n")
 
@@ -633,7 +747,100 @@ def psiTimeCourse(posteriorDir, settings_f, event, out_f):
     savefig(out_f)
 
 
-def psiTable(summarydir, out_f, includelist_f=False, minct=10):
+def _psiTableParse(args):
+    """ Map step of psiTable: parse one comparison file into columns and apply the minct filter
+
+    Args:
+        args (tuple): (path to MISO summary comparison file, minct)
+
+    Returns:
+        Tuple. (sample 1, sample 2, number of events parsed, events, sample 1 psi, sample 2 psi, [gene, symb, desc]) for the events where both samples have at least minct reads
+
+    """
+    bf_f, minct = args
+    header = None
+    rows = []
+    for line in open(bf_f):
+        if line.startswith("#"):
+            header = line[1:].strip().split("\t")
+        else:
+            vals = line.strip().split("\t")
+            # Same rows as getSummary, which skips events without gene information
+            if len(vals) >= 22:
+                rows.append(vals)
+    if header is None or len(rows) == 0:
+        return None, None, 0, [], [], [], []
+
+    ct1 = parseCountsColumn([vals[10] for vals in rows])
+    ct2 = parseCountsColumn([vals[12] for vals in rows])
+    keep = where(minimum(ct1, ct2) >= minct)[0]
+    rows = [rows[i] for i in keep]
+    psi1 = array([vals[1].split(",", 1)[0] for vals in rows], dtype=float).tolist()
+    psi2 = array([vals[4].split(",", 1)[0] for vals in rows], dtype=float).tolist()
+    return header[1], header[4], len(ct1), [vals[0] for vals in rows], psi1, psi2, \
+        [vals[19:22] for vals in rows]
+
+
+def _psiTableParseSamples(args):
+    """ Parse one comparison file per sample: psi of the events where that sample has at least minct reads
+
+    Args:
+        args (tuple): (path to MISO summary comparison file, minct)
+
+    Returns:
+        List. For sample 1 and sample 2, (sample, events parsed, events passing minct, psi values, [gene, symb, desc])
+
+    """
+    bf_f, minct = args
+    header = None
+    rows = []
+    for line in open(bf_f):
+        if line.startswith("#"):
+            header = line[1:].strip().split("\t")
+        else:
+            vals = line.strip().split("\t")
+            if len(vals) >= 22:
+                rows.append(vals)
+    if header is None:
+        return []
+
+    events = [vals[0] for vals in rows]
+    sides = []
+    for name, psicol, ctcol in [(header[1], 1, 10), (header[4], 4, 12)]:
+        cts = parseCountsColumn([vals[ctcol] for vals in rows])
+        keep = where(cts >= minct)[0]
+        psis = array([rows[i][psicol].split(",", 1)[0] for i in keep], dtype=float).tolist()
+        sides.append((name, events, [events[i] for i in keep], psis, \
+            [rows[i][19:22] for i in keep]))
+    return sides
+
+
+def planComparisons(comps, samples=None):
+    """ Pick a small set of pairwise comparison files that together contain every sample
+
+    Args:
+        comps (list): Comparison file names, <sample1>_vs_<sample2>.miso_bf
+        samples (list): Samples to cover. All samples in <comps> by default
+
+    Returns:
+        List. Comparison files to read, each covering at least one sample not covered before; about half as many files as samples
+
+    """
+    pairs = [(c, c.split(".")[0].split("_vs_")) for c in comps]
+    if samples is None:
+        samples = set([s for c, pair in pairs for s in pair])
+    uncovered = set(samples)
+    plan = []
+    # Pairs of uncovered samples first, then single samples left over
+    for needed in [2, 1]:
+        for c, pair in pairs:
+            if len(uncovered.intersection(pair)) >= needed and c not in plan:
+                plan.append(c)
+                uncovered.difference_update(pair)
+    return plan
+
+
+def psiTable(summarydir, out_f, includelist_f=False, minct=10, nprocs=1, fullscan=False):
     """ Create a table of psi values, where rows are events and columns are samples. You can specify the samples to include in the includelist file.
 
     Args:
@@ -641,46 +848,47 @@ def psiTable(summarydir, out_f, includelist_f=False, minct=10):
         out_f (str/path): Label for the resulting text file
         includelist_f (bool): An optional file where samples are listed one per line and will dictate which samples are included in the final table
         minct (int): The minimum number of reads mapped to an exon junction to be included in the table
+        nprocs (int): Number of comparison files parsed at once
+        fullscan (bool): Read every pairwise comparison file. By default only enough comparisons to cover each sample once are read; another comparison of a sample is read only for an event passing minct in every other sample but not yet known to be present or absent in it
 
     Returns:
        Nothing. Generates a table of order psi values, where raw read counts for a given event are greater than minct for all samples
 
     """
     minct = int(minct)
+    nprocs = int(nprocs)
     comps = [f for f in os.listdir(summarydir) if f.endswith("miso_bf")]
+    if fullscan is False or fullscan == 'False':
+        return _psiTablePlanned(summarydir, comps, out_f, includelist_f, minct, nprocs)
+    tasks = [(os.path.join(summarydir, comp), minct) for comp in comps]
+    if nprocs > 1:
+        from multiprocessing import Pool
+        pool = Pool(nprocs)
+        results = pool.imap(_psiTableParse, tasks)
+    else:
+        results = (_psiTableParse(task) for task in tasks)
+
+    # Reduce in file order, so the first comparison passing minct gives each sample's psi
     eventToSample = {}
     eventToGene = {}
     samples = {}
-    for comp in comps:
+    for comp, result in zip(comps, results):
         print comp
-        eventToInfo, header = getSummary(os.path.join(summarydir, comp))
-        for event in eventToInfo:
+        sample1, sample2, nparsed, events, psi1, psi2, genes = result
+        if nparsed == 0:
+            continue
+        samples[sample1] = 0
+        samples[sample2] = 0
+        for i in range(len(events)):
+            event = events[i]
             if event not in eventToSample:
                 eventToSample[event] = {}
-
-            sample1 = header[1]
-            sample2 = header[4]
-            samples[sample1] = 0
-            samples[sample2] = 0
-
-            bf = eventToInfo[event]['bayes factor']
-            s1c = eventToInfo[event]['sample 1 counts']
-            s2c = eventToInfo[event]['sample 2 counts']
-
-            ct1 = parseCounts(s1c)
-            ct2 = parseCounts(s2c)
-
-            if min([ct1, ct2]) >= minct:
-                if event not in eventToGene:
-                    eventToGene[event] = [eventToInfo[event]['gene'],
-                                          eventToInfo[event]['symb'], \
-                                          eventToInfo[event]['desc']]
-                if sample1 not in eventToSample[event]:
-                    eventToSample[event][sample1] = \
-                        eventToInfo[event]['sample 1 mean'][0]
-                if sample2 not in eventToSample[event]:
-                    eventToSample[event][sample2] = \
-                        eventToInfo[event]['sample 2 mean'][0]
+                eventToGene[event] = genes[i]
+            eventToSample[event].setdefault(sample1, psi1[i])
+            eventToSample[event].setdefault(sample2, psi2[i])
+    if nprocs > 1:
+        pool.close()
+        pool.join()
 
     if includelist_f is not False:
         samples = []
@@ -707,53 +915,210 @@ def psiTable(summarydir, out_f, includelist_f=False, minct=10):
     out.close()
 
 
-def correlMatrix(table_f, out_f, includelist_f=False):
+def _psiTablePlanned(summarydir, comps, out_f, includelist_f, minct, nprocs):
+    """ psiTable reading a covering set of comparisons. Each sample's psi needs only one file containing it, since the sample's counts are the same in all of its comparisons. """
+    include = None
+    if includelist_f is not False:
+        include = []
+        for line in open(includelist_f):
+            include.append(line.strip())
+        wanted = [s[:-len("_posterior_mean")] if s.endswith("_posterior_mean") else s \
+            for s in include]
+        comps = [c for c in comps if len(set(wanted).intersection(\
+            c.split(".")[0].split("_vs_"))) > 0]
+    else:
+        wanted = None
+
+    if nprocs > 1:
+        from multiprocessing import Pool
+        pool = Pool(nprocs)
+        mapper = pool.map
+    else:
+        mapper = map
+
+    sampleToSeen = {}    # sample -> events present in the comparisons read
+    sampleToPsi = {}     # sample -> event -> psi, for events passing minct
+    sampleToFiles = {}   # sample -> events of each of its comparisons read
+    nameToSample = {}    # sample name in comparison file names -> sample column
+    eventToGene = {}
+    done = []
+
+    def read(batch):
+        for comp, sides in zip(batch, mapper(_psiTableParseSamples, \
+                [(os.path.join(summarydir, c), minct) for c in batch])):
+            print comp
+            done.append(comp)
+            for name, side in zip(comp.split(".")[0].split("_vs_"), sides):
+                sample, events, passing, psis, genes = side
+                nameToSample[name] = sample
+                sampleToSeen.setdefault(sample, set()).update(events)
+                sampleToFiles.setdefault(sample, []).append(set(events))
+                eventToPsi = sampleToPsi.setdefault(sample, {})
+                for i in range(len(passing)):
+                    eventToPsi.setdefault(passing[i], psis[i])
+                    eventToGene.setdefault(passing[i], genes[i])
+
+    def passingElsewhere():
+        # sample -> events passing minct in every other sample
+        counts = {}
+        for sample in sampleToPsi:
+            for e in sampleToPsi[sample]:
+                counts[e] = counts.get(e, 0) + 1
+        n = len(sampleToSeen)
+        everywhere = set([e for e in counts if counts[e] == n])
+        once = [e for e in counts if counts[e] == n - 1]
+        return dict([(sample, everywhere.union([e for e in once if e not in sampleToPsi[sample]])) \
+                     for sample in sampleToSeen])
+
+    def learn(nfiles):
+        # Events passing in every other sample but missing from a comparison are absent from the sample
+        elsewhere = passingElsewhere()
+        for sample in sampleToFiles:
+            for events in sampleToFiles[sample][nfiles.get(sample, 0):]:
+                absent.setdefault(sample, set()).update(elsewhere[sample].difference(events))
+
+    absent = {}
+    read(planComparisons(comps, wanted))
+    learn({})
+
+    # A comparison holds the events present in both of its samples, so an event
+    # missing from every comparison of a sample is usually absent from it. Another
+    # comparison of that sample is read only for events passing minct in every
+    # other sample, which its partner is then known to contain: reading it shows
+    # whether the event is present in the sample or absent from it.
+    while True:
+        dead = set()
+        for sample in sampleToSeen:
+            dead.update(sampleToSeen[sample].difference(sampleToPsi[sample]))
+            dead.update(absent.get(sample, set()))
+        batch = []
+        elsewhere = passingElsewhere()
+        for sample in sampleToSeen:
+            chase = elsewhere[sample].difference(dead, sampleToSeen[sample])
+            if len(chase) == 0:
+                continue
+            names = [n for n in nameToSample if nameToSample[n] == sample]
+            unread = [c for c in comps if c not in done and c not in batch and \
+                      len(set(names).intersection(c.split(".")[0].split("_vs_"))) > 0]
+            if len(unread) == 0:
+                absent.setdefault(sample, set()).update(chase)
+            else:
+                batch.append(unread[0])
+        if len(batch) == 0:
+            break
+        nfiles = dict([(sample, len(sampleToFiles[sample])) for sample in sampleToFiles])
+        read(batch)
+        learn(nfiles)
+    if nprocs > 1:
+        pool.close()
+        pool.join()
+
+    if include is not None:
+        samples = include
+    else:
+        samples = sorted(sampleToPsi.keys())
+
+    out = open(out_f, 'w')
+    print len(samples), 'samples', len(done), 'of', len(comps), 'comparisons read'
+    out.write("#Event\t" + "\t".join(samples) + "\n")
+    for event in eventToGene:
+        if min([event in sampleToPsi.get(s, {}) for s in samples]):
+            out.write(event + "\t")
+            out.write("\t".join(map(str, [sampleToPsi[s][event] for s in samples])) + "\t")
+            out.write("\t".join(eventToGene[event]) + "\n")
+    out.close()
+
+
+def readPsiMatrix(table_f, samples=None):
+    """ Read a psi table into a matrix
+
+    Args:
+        table_f (str/path): MISO psiTable generated from psiTable or psiTableFromPsiFiles
+        samples (list): Samples to read, in this order. All samples of the table by default
+
+    Returns:
+        Tuple. (events, samples, float32 matrix of psi values with one row per event and one column per sample; NaN where the table has n/a)
+
+    """
+    events = []
+    rows = []
+    for line in open(table_f):
+        if line.startswith("#"):
+            header = line.strip().split("\t")[1:]
+        else:
+            vals = line.rstrip("\n").split("\t")
+            events.append(vals[0])
+            rows.append(vals[1:len(header) + 1])
+
+    if samples is None:
+        samples = header
+    cols = [header.index(s) for s in samples]
+    data = array(rows).reshape(len(rows), len(header))[:, cols]
+    data[data == 'n/a'] = 'nan'
+    return events, samples, data.astype(float32)
+
+
+def correlMatrix(table_f, out_f, includelist_f=False, method='pearson', cache_f=False, \
+                 cluster=False):
     """ Make a correlation matrix for visualizing correlations between samples using psi values.
 
     Args:
         table_f (str/path): MISO psiTable generated from psiTable function
         out_f (str/path): Label for the resulting correlation figure
         includelist_f (bool): An optional file where samples are listed one per line and will dictate which samples are included in the final table
+        method (str): pearson or spearman. Missing (n/a) psi values are left out pair by pair
+        cache_f (str/path): An optional file keeping the correlation matrix, reused while the table, samples and method are unchanged
+        cluster (str): Order samples by hierarchical clustering of 1 - correlation, with this linkage method i.e. average, complete (needs scipy). File order by default
 
     Returns:
        Nothing. Generates a correlation figure as <out_f>.png
 
     """
+    labels = None
     if includelist_f is not False:
         labels = []
         for line in open(includelist_f):
             labels.append(line.strip())
-        labelToIdx = {}
 
-    data = []
-    for line in open(table_f):
-        if line.startswith("#"):
-            header = line.strip().split("\t")[1:]
-            if includelist_f is not False:
-                for i in range(len(header)):
-                    labelToIdx[header[i]] = i
-            else:
-                labels = header
-        else:
-            psivals = map(float, line.strip().split("\t")[1:-3])
-            if includelist_f is not False:
-                data.append([psivals[labelToIdx[labels[i]]] \
-                             for i in range(len(labels))])
-            else:
-                data.append(psivals)
+    st = os.stat(table_f)
+    key = "\t".join(map(str, [os.path.abspath(table_f), st.st_size, st.st_mtime, method] + \
+                              (labels or [])))
+    cc = None
+    if cache_f is not False and os.path.exists(cache_f):
+        cached = load(cache_f)
+        if str(cached['key']) == key:
+            print 'Using cached correlations', cache_f
+            cc = cached['cc']
+            labels = list(cached['labels'])
+
+    if cc is None:
+        events, labels, data = readPsiMatrix(table_f, labels)
+        print data.shape, 'dimensions'
+        cc = misoStats.correlation(data, method)
+        if cache_f is not False:
+            out = open(cache_f, 'wb')
+            savez(out, key=key, cc=cc, labels=labels)
+            out.close()
+
+    if cluster is not False and cluster != 'False':
+        from scipy.cluster.hierarchy import linkage, leaves_list
+        # Condensed upper triangle of the distances, never the full square copy
+        iu = triu_indices(len(labels), 1)
+        dist = 1 - cc[iu]
+        dist[isnan(dist)] = 1
+        order = leaves_list(linkage(dist, method=cluster))
+        cc = cc[order][:, order]
+        labels = [labels[i] for i in order]
 
-    data = array(data)
-    print data.shape, 'dimensions'
-
-    cc = corrcoef(data.T)
     my_cmap = jet()
 
     fig = figure(figsize=(8, 6))
-    pcolor(cc, cmap=my_cmap)
-    xticks(arange(data.shape[1]) + .5, labels, rotation=90, fontsize=6)
-    yticks(arange(data.shape[1]) + .5, labels, fontsize=6)
-    xlim(0, data.shape[1])
-    ylim(0, data.shape[1])
+    imshow(cc, cmap=my_cmap, origin='lower', interpolation='nearest', aspect='auto', \
+           extent=[0, len(labels), 0, len(labels)])
+    xticks(arange(len(labels)) + .5, labels, rotation=90, fontsize=6)
+    yticks(arange(len(labels)) + .5, labels, fontsize=6)
+    xlim(0, len(labels))
+    ylim(0, len(labels))
 
     subplots_adjust(left=.4, bottom=.4)
     colorbar()
@@ -993,6 +1358,75 @@ def countRegulatedFromTables(table1_f, table2_f, groups1_f, groups2_f, out_f):
     out.close()
 
 
+# Parsed UTR coordinates of the last event list seen, keyed on a hash of the event IDs
+_utrParsed = {}
+
+
+def parseUTREvents(events):
+    """ Parse the coordinates of TandemUTR/ALE event IDs (chrom:start:end:strand@chrom:start:end:strand...) into arrays
+
+    Args:
+        events (list): Event IDs
+
+    Returns:
+        Tuple. (number of UTRs per event, matrix of UTR lengths from the shared UTR start, one row per event sorted longest first and padded with 0). Parses are reused while the same event list is passed again.
+
+    """
+    import hashlib
+    key = hashlib.sha1("\n".join(events)).hexdigest()
+    if key in _utrParsed:
+        return _utrParsed[key]
+
+    nutrs = array([e.count("@") + 1 for e in events], dtype=int)
+    lengths = zeros((len(events), max(nutrs) if len(events) > 0 else 0), dtype=int)
+    # Events with the same number of UTRs are split and measured together
+    for k in unique(nutrs):
+        idx = nonzero(nutrs == k)[0]
+        fields = ":".join([events[i] for i in idx]).replace("@", ":").split(":")
+        if len(fields) != len(idx) * 4 * k:
+            raise ValueError("Event IDs are not chrom:start:end:strand@... UTR coordinates")
+        fields = array(fields).reshape(len(idx), k, 4)
+        starts = fields[:, :, 1].astype(int)
+        ends = fields[:, :, 2].astype(int)
+        plus = fields[:, -1, 3] == '+'
+        utrlengths = where(plus[:, newaxis], ends - starts.min(axis=1)[:, newaxis], \
+                           ends.max(axis=1)[:, newaxis] - starts)
+        lengths[idx, :k] = -sort(-utrlengths, axis=1)
+
+    _utrParsed.clear()
+    _utrParsed[key] = (nutrs, lengths)
+    return nutrs, lengths
+
+
+def meanUTRlengths(eventToInfo, events=None):
+    """ Psi weighted mean UTR length of both samples for all events at once
+
+    Args:
+        eventToInfo (dict): Dictionary providing summary information for a given event
+        events (list): Events to compute, in this order. All events of <eventToInfo> by default
+
+    Returns:
+        Tuple. (events, sample 1 mean lengths, sample 2 mean lengths, number of UTRs per event, UTR lengths matrix from parseUTREvents)
+
+    """
+    if events is None:
+        events = eventToInfo.keys()
+    nutrs, lengths = parseUTREvents(events)
+
+    # Psi of each isoform, longest UTR first; a single psi implies 1 - psi for the other isoform
+    psis = []
+    for sample in ['sample 1 mean', 'sample 2 mean']:
+        P = zeros(lengths.shape)
+        for i in range(len(events)):
+            m = eventToInfo[events[i]][sample]
+            if len(m) == 1:
+                P[i, :2] = [m[0], 1 - m[0]]
+            else:
+                P[i, :len(m)] = m
+        psis.append((lengths * P).sum(axis=1))
+    return events, psis[0], psis[1], nutrs, lengths
+
+
 def getMeanUTRlength(eventToInfo):
     """ Return dictionary containing mean UTR length
 
@@ -1003,31 +1437,12 @@ def getMeanUTRlength(eventToInfo):
         Dictionary containing the length for the UTR of a given event
 
     """
+    events, m1lengths, m2lengths, nutrs, lengths = meanUTRlengths(eventToInfo)
+    m1lengths = m1lengths.tolist()
+    m2lengths = m2lengths.tolist()
     eventToLength = {}
-    for event in eventToInfo:
-        utrs = event.split("@")
-        starts = []
-        ends = []
-        for utr in utrs:
-            chrom, s, e, strand = utr.split(":")
-            starts.append(int(s))
-            ends.append(int(e))
-        if strand == '+':
-            utrstart = min(starts)
-            lengths = [e - utrstart for e in ends]
-        else:
-            utrstart = max(ends)
-            lengths = [utrstart - s for s in starts]
-        lengths = sorted(lengths)[::-1]
-
-        m1 = list(eventToInfo[event]['sample 1 mean'])
-        m2 = list(eventToInfo[event]['sample 2 mean'])
-        if len(m1) == 1:
-            m1.append(1 - m1[0])
-            m2.append(1 - m2[0])
-        m1length = sum([lengths[x] * m1[x] for x in range(len(m1))])
-        m2length = sum([lengths[x] * m2[x] for x in range(len(m2))])
-        eventToLength[event] = [m1length, m2length, lengths]
+    for i in range(len(events)):
+        eventToLength[events[i]] = [m1lengths[i], m2lengths[i], lengths[i, :nutrs[i]].tolist()]
     return eventToLength
 
 
@@ -1043,32 +1458,62 @@ def compareMeanUTRlengths(summary_f, out_f):
 
     """
     eventToInfo, header = getSummary(summary_f)
-    eventToLength = getMeanUTRlength(eventToInfo)
+    events, m1lengths, m2lengths, nutrs, lengths = meanUTRlengths(eventToInfo)
+    maxbf = array([eventToInfo[e]['max bf'] for e in events])
+    dpsi = array([eventToInfo[e]['delta psi'][0] for e in events])
 
     minbf = 5
-    sigevents = [e for e in eventToInfo if eventToInfo[e]['max bf'] >= minbf]
     dpsis = [0, .2, .4, .5]
+    # Significant two-UTR events at least 100 nt apart, then one column per delta psi threshold
+    base = (maxbf >= minbf) & (nutrs == 2) & (lengths[:, 0] - lengths[:, 1] >= 100)
+    passing = base[:, newaxis] & (abs(dpsi)[:, newaxis] >= array(dpsis)[newaxis, :])
     cm = get_cmap('hot')
-    for dpsi in dpsis:
-        data = []
-        for e in sigevents:
-            m1length, m2length, lengths = eventToLength[e]
-            if len(lengths) == 2 and lengths[0] - lengths[1] >= 100 and \
-                            abs(eventToInfo[e]['delta psi'][0]) >= dpsi:
-                data.append([m1length, m2length, eventToInfo[e]['delta psi'][0]])
-
-        data = array(data)
+    for j in range(len(dpsis)):
+        idx = passing[:, j]
+        data = vstack((m1lengths[idx], m2lengths[idx], dpsi[idx])).T
         print median(data[:, 0]), median(data[:, 1]), mean(data[:, 2])
         print data.shape
         print median((data[:, 0] - data[:, 1]))
         y, x, p = hist(data[:, 0] - data[:, 1], linspace(-500, 500, 40), \
                        visible=False, normed=True, cumulative=True)
-        plot(x[1:], y, color=cm(dpsi))
+        plot(x[1:], y, color=cm(dpsis[j]))
     savefig(out_f)
 
 
+def useDensity(density, npoints):
+    """ Resolve a plot's density argument: True/False, or 'auto' for at least DENSITY_MIN points """
+    if density == 'auto':
+        return npoints >= DENSITY_MIN
+    return density is True or density == 'True'
+
+
+def densityImage(x, y, bins=200, extent=[-.1, 1.1, -.1, 1.1], cmap=cm.Greys, zorder=1):
+    """Draw points as a 2D histogram image instead of individual markers
+
+    Args:
+        x (array): x values
+        y (array): y values
+        bins (int): Number of bins along each axis
+        extent (list): [xmin, xmax, ymin, ymax] covered by the image
+        cmap (colormap): Colormap; empty bins are left transparent
+        zorder (int): Drawing order of the image
+
+    Returns:
+       Image. Counts are log scaled and kept in the lighter half of <cmap>, so markers drawn over them stand out
+
+    """
+    bins = int(bins)
+    H, xedges, yedges = histogram2d(x, y, bins=bins, \
+                                    range=[extent[:2], extent[2:]])
+    top = log1p(max(H.max(), 1))
+    H = log1p(ma.masked_equal(H.T, 0))
+    return imshow(H, origin='lower', extent=extent, cmap=cmap, interpolation='nearest', \
+                  aspect='auto', vmin=0, vmax=2 * top, zorder=zorder)
+
+
 def fancyScatter(summary_f, out_f, mindpsi=0.05, minbf=5, \
-                 xtext=None, ytext=None, figheight=3, figwidth=3):
+                 xtext=None, ytext=None, figheight=3, figwidth=3, nbins=29, \
+                 density='auto', densitybins=200):
     """ Generates a filtered scatter plot based on a MISO summary file
 
     Args:
@@ -1080,6 +1525,9 @@ def fancyScatter(summary_f, out_f, mindpsi=0.05, minbf=5, \
         ytext (str): Label for y-axis i.e. sample two
         figheight (int): Set canvas height
         figwidth (int): Set canvas width
+        nbins (int): Number of bins of the spread envelope
+        density (str): Draw events that are not significant as a density image: True, False, or auto to do so from DENSITY_MIN events
+        densitybins (int): Number of density image bins along each axis
 
     Returns:
         Nothing. Generates a scatter plot of psi values that meet both delta psi and bayes factor metrics.
@@ -1100,40 +1548,24 @@ def fancyScatter(summary_f, out_f, mindpsi=0.05, minbf=5, \
     figheight = float(figheight)
     figwidth = float(figwidth)
     figure(figsize=(figwidth, figheight))
-    a = pi / 4.
-    R = array([[cos(a), -sin(a)], [sin(a), cos(a)]])
-    rotated = dot(vstack((data[:, 0], data[:, 1])).T, R)
-    xvals = linspace(0, sqrt(2), 30)
-    plusspread = []
-    minusspread = []
-    for x in range(len(xvals) - 1):
-        idx = where((rotated[:, 0] >= xvals[x]) & \
-                    (rotated[:, 0] <= xvals[x + 1]))[0]
-        plusspread.append([xvals[x:x + 2].mean(), rotated[idx, 1].std()])
-        minusspread.insert(0, [xvals[x:x + 2].mean(), -rotated[idx, 1].std()])
-
-    plusspread = array(plusspread)
-    minusspread = array(minusspread)
-
-    a = -pi / 4.
-    R = array([[cos(a), -sin(a)], [sin(a), cos(a)]])
-    plusrotated = dot(plusspread, R)
-    minusrotated = dot(minusspread, R)
-    allrotated = vstack((plusrotated, minusrotated))
+    allrotated = spreadEnvelope(data[:, 0], data[:, 1], nbins)
 
     mindpsi = float(mindpsi)
     minbf = float(minbf)
     fill(allrotated[:, 0], allrotated[:, 1], color='#EEEEEE', zorder=0)
     idx = where((abs(data[:, 2]) < mindpsi) | (data[:, 3] < minbf))[0]
-    scatter(data[idx, 0], data[idx, 1], s=.5, color='#CCCCCC', \
-            rasterized=True)
+    if useDensity(density, len(idx)):
+        densityImage(data[idx, 0], data[idx, 1], densitybins)
+    else:
+        scatter(data[idx, 0], data[idx, 1], s=.5, color='#CCCCCC', \
+                rasterized=True)
 
     xmin, xmax = [-.1, 1.1]
     ymin, ymax = [-.1, 1.1]
 
     idx = where((abs(data[:, 2]) >= mindpsi) & (data[:, 3] >= minbf))[0]
     scatter(data[idx, 0], data[idx, 1], s=3 + log(data[idx, 3]) / log(1000), \
-            facecolor='w', alpha=.8, lw=.5)
+            facecolor='w', alpha=.8, lw=.5, rasterized=len(idx) >= RASTERIZE_MIN)
 
     nup = len(where(data[idx, 2] < 0)[0])
     ndn = len(where(data[idx, 2] > 0)[0])
@@ -1153,26 +1585,65 @@ def fancyScatter(summary_f, out_f, mindpsi=0.05, minbf=5, \
 
     subplots_adjust(bottom=.12)
     savefig(out_f, dpi=300)
+    close()
+
 
+def _fancyScatterOne(args):
+    """ Render one fancyScatter for fancyScatterWrapper, returning (summary file, figure, status) """
+    summary_f, out_f, mindpsi, minbf = args
+    try:
+        fancyScatter(summary_f, out_f, mindpsi, minbf)
+        status = 'ok'
+    except Exception, e:
+        status = 'failed: %s' % str(e).replace("\n", " ")
+    close('all')
+    return summary_f, out_f, status
 
-def fancyScatterWrapper(summarydir, outdir):
+
+def fancyScatterWrapper(summarydir, outdir, nprocs=1, mindpsi=0.05, minbf=5):
     """ Generates filtered scatter plots based on a MISO summary files contained within a summary directory
 
     Args:
         summarydir (str/path): Directory containing MISO summary psiTables
         outdir (str)/path: Label for scatter plot figure <summary_file_name>.pdf
+        nprocs (int): Number of figures rendered at once
+        mindpsi (float): Minimum delta psi metric for a given event
+        minbf (int): Minimum bayes factor metric for a given event
 
     Returns:
-        Nothing. Generates scatter plots of psi values that meet both delta psi and bayes factor metrics.
+        Nothing. Generates scatter plots of psi values that meet both delta psi and bayes factor metrics, and <outdir>/fancyScatter.manifest listing each summary file, its figure and whether it was rendered.
 
     """
-    for f in os.listdir(summarydir):
-        fancyScatter(os.path.join(summarydir, f), \
-                     os.path.join(outdir, os.path.basename(f) + '.pdf'))
+    nprocs = int(nprocs)
+    tasks = [(os.path.join(summarydir, f), os.path.join(outdir, os.path.basename(f) + '.pdf'), \
+              mindpsi, minbf) for f in sorted(os.listdir(summarydir))]
+
+    if nprocs > 1:
+        from multiprocessing import Pool
+        # Workers are replaced regularly so matplotlib memory does not build up
+        pool = Pool(nprocs, maxtasksperchild=50)
+        results = pool.imap_unordered(_fancyScatterOne, tasks)
+    else:
+        pool = None
+        results = (_fancyScatterOne(t) for t in tasks)
+
+    done = {}
+    for summary_f, out_f, status in results:
+        print out_f, status
+        done[summary_f] = (out_f, status)
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    out = open(os.path.join(outdir, 'fancyScatter.manifest'), 'w')
+    out.write("#summary\tfigure\tstatus\n")
+    for summary_f, out_f, mindpsi, minbf in tasks:
+        out.write("\t".join([summary_f, out_f, done[summary_f][1]]) + "\n")
+    out.close()
 
 
 def fancyScatterMini(summary_f, out_f, mindpsi=0.05, minbf=5, \
-                     xtext=None, ytext=None, figheight=3, figwidth=3):
+                     xtext=None, ytext=None, figheight=3, figwidth=3, nbins=29):
     """ Generates a miniture filtered scatter plot based on a MISO summary file
 
     Args:
@@ -1184,6 +1655,7 @@ def fancyScatterMini(summary_f, out_f, mindpsi=0.05, minbf=5, \
         ytext (str): Label for y-axis i.e. sample two
         figheight (int): Set canvas height
         figwidth (int): Set canvas width
+        nbins (int): Number of bins of the spread envelope
 
     Returns:
         Nothing. Generates a scatter plot of psi values that meet both delta psi and bayes factor metrics.
@@ -1204,26 +1676,7 @@ def fancyScatterMini(summary_f, out_f, mindpsi=0.05, minbf=5, \
     figheight = float(figheight)
     figwidth = float(figwidth)
     figure(figsize=(figwidth, figheight))
-    a = pi / 4.
-    R = array([[cos(a), -sin(a)], [sin(a), cos(a)]])
-    rotated = dot(vstack((data[:, 0], data[:, 1])).T, R)
-    xvals = linspace(0, sqrt(2), 30)
-    plusspread = []
-    minusspread = []
-    for x in range(len(xvals) - 1):
-        idx = where((rotated[:, 0] >= xvals[x]) & \
-                    (rotated[:, 0] <= xvals[x + 1]))[0]
-        plusspread.append([xvals[x:x + 2].mean(), rotated[idx, 1].std()])
-        minusspread.insert(0, [xvals[x:x + 2].mean(), -rotated[idx, 1].std()])
-
-    plusspread = array(plusspread)
-    minusspread = array(minusspread)
-
-    a = -pi / 4.
-    R = array([[cos(a), -sin(a)], [sin(a), cos(a)]])
-    plusrotated = dot(plusspread, R)
-    minusrotated = dot(minusspread, R)
-    allrotated = vstack((plusrotated, minusrotated))
+    allrotated = spreadEnvelope(data[:, 0], data[:, 1], nbins)
 
     mindpsi = float(mindpsi)
     minbf = float(minbf)
@@ -1237,7 +1690,7 @@ def fancyScatterMini(summary_f, out_f, mindpsi=0.05, minbf=5, \
 
     idx = where((abs(data[:, 2]) >= mindpsi) & (data[:, 3] >= minbf))[0]
     scatter(data[idx, 0], data[idx, 1], s=1 + log(data[idx, 3]) / log(100000), \
-            facecolor='w', alpha=.8, lw=.25)
+            facecolor='w', alpha=.8, lw=.25, rasterized=len(idx) >= RASTERIZE_MIN)
 
     nup = len(where(data[idx, 2] < 0)[0])
     ndn = len(where(data[idx, 2] > 0)[0])
@@ -1259,6 +1712,7 @@ def fancyScatterMini(summary_f, out_f, mindpsi=0.05, minbf=5, \
 
     subplots_adjust(bottom=.2, left=.2)
     savefig(out_f, dpi=300)
+    close()
 
 
 def plotHeatmap(event, summarydir, names, out_f):
@@ -1695,15 +2149,16 @@ def plotFromConsolidated(consolidated_f, groups_f, event, minbf, out_f=False):
         savefig(out_f)
 
 
-def collapseCI(consolidated_f, groups_f, out_f):
+def collapseCI(consolidated_f, groups_f, out_f, weighting='ci'):
     """ Collapse CIs (get a weighted average of psi values with sample groups)
 
     Args:
         consolidated_f (str/path): Directory containing MISO consolidated summary psiTable
         groups_f (str/path): Text file, tab delimited, denotes sample and corresponding group one sample per line, respectfully.
         out_f (str): The label for the resulting text file
+        weighting (str): How samples are weighted within a group: ci (1/CI), ci2 (1/CI^2) or equal. A comma delimited list, i.e. ci,ci2,equal, writes <group>_<weighting>_low/mean/high columns for each
     Returns:
-        Nothing. Generates a text file where each psi value represents the weighted average of psi values within sample groups
+        Nothing. Generates a text file where each psi value represents the weighted average of psi values within sample groups. CIs are the same weighted average of sample CIs for ci and equal, and the inverse-variance pooled CI, 1/sqrt(sum of 1/CI^2), for ci2
 
     """
     groupToSamples = {}
@@ -1720,57 +2175,75 @@ def collapseCI(consolidated_f, groups_f, out_f):
     groups = groupToSamples.keys()
     print len(sampleToGroup), 'samples'
 
-    out = open(out_f, 'w')
-    out.write("#Event")
-    for g in groups:
-        out.write("\t" + "\t".join([g + "_low", g + "_mean", g + "_high"]))
-    out.write("\tGene\tSymb\tDesc\n")
+    events = []
+    rows = []
+    genes = []
     for line in open(consolidated_f):
         if line.startswith("#"):
             header = line.strip().split("\t")
-            for i in range(1, len(header)):
-                if header[i].endswith("_low"):
-                    idx = 0
-                    sample = header[i][:-4]
-                elif header[i].endswith("_mean"):
-                    idx = 1
-                    sample = header[i][:-5]
-                elif header[i].endswith("_high"):
-                    idx = 2
-                    sample = header[i][:-5]
-                if "_vs_" in header[i]:
-                    break
         else:
             vals = line.strip().split("\t")
-            event = vals[0]
-            out.write(event)
-            groupToVals = {}
-            for i in range(len(sampleToGroup)):
-                low = vals[3 * i + 1]
-                mean = vals[3 * i + 2]
-                high = vals[3 * i + 3]
-                sample = header[3 * i + 1][:-4]
-                group = sampleToGroup[sample]
-                if 'n/a' not in [low, mean, high]:
-                    try:
-                        groupToVals[group].append(map(float, [low, mean, high]))
-                    except:
-                        groupToVals[group] = [map(float, [low, mean, high])]
-            for g in groups:
-                if g in groupToVals:
-                    mat = array(groupToVals[g])
-                    CIs = mat[:, 2] - mat[:, 0]
-                    newmean = (mat[:, 1] * 1 / CIs).sum() / (1 / CIs).sum()
-                    newCI = (CIs * 1 / CIs).sum() / (1 / CIs).sum()
-                    # newCI = 1 / (1 / (CIs * CIs)).sum()
-                    print mat[:, 1], CIs, newmean, newCI
-                    newlow = max([0, round(newmean - newCI / 2, 2)])
-                    newhigh = min([1, round(newmean + newCI / 2, 2)])
-                    newmean = round(newmean, 2)
-                    newmean2 = (mat[:, 1] * 1 / (CIs * CIs)).sum() / (1 / (CIs * CIs)).sum()
-                    newmean2 = round(newmean2, 2)
-                    out.write("\t" + "\t".join(map(str, [newlow, newmean, newhigh])))
+            events.append(vals[0])
+            rows.append(vals[1: 3 * len(sampleToGroup) + 1])
+            genes.append("\t".join(vals[-3:]))
+
+    # Columns of each group's samples, from the <sample>_low header of each low/mean/high triplet
+    groupToCols = dict([(g, []) for g in groups])
+    for i in range(len(sampleToGroup)):
+        groupToCols[sampleToGroup[header[3 * i + 1][:-4]]].append(i)
+
+    data = array(rows).reshape(len(rows), 3 * len(sampleToGroup))
+    missing = data == 'n/a'
+    data[missing] = 'nan'
+    data = data.astype(float)
+    low = data[:, 0::3]
+    mean = data[:, 1::3]
+    high = data[:, 2::3]
+    # Samples with any of low/mean/high n/a are left out of their group
+    valid = ~(missing[:, 0::3] | missing[:, 1::3] | missing[:, 2::3])
+    CIs = high - low
+
+    schemes = weighting.split(",")
+    columns = []
+    names = []
+    for scheme in schemes:
+        if scheme not in ['ci', 'ci2', 'equal']:
+            raise ValueError("Unknown weighting %s" % scheme)
+        for g in groups:
+            cols = array(groupToCols[g], dtype=int)
+            ok = valid[:, cols]
+            ci = CIs[:, cols]
+            # Each sample weighs 1/<divisor>
+            if scheme == 'ci':
+                divisor = ci
+            elif scheme == 'ci2':
+                divisor = ci * ci
+            else:
+                divisor = ones(ci.shape)
+            with errstate(divide='ignore', invalid='ignore'):
+                wsum = where(ok, 1 / divisor, 0).sum(axis=1)
+                newmean = where(ok, mean[:, cols] / divisor, 0).sum(axis=1) / wsum
+                if scheme == 'ci2':
+                    # Inverse-variance pooling, treating each CI width as proportional to its standard error
+                    newCI = 1 / sqrt(wsum)
                 else:
-                    out.write("\tn/a\tn/a\tn/a")
-            out.write("\t" + "\t".join(vals[-3:]) + "\n")
+                    newCI = where(ok, ci / divisor, 0).sum(axis=1) / wsum
+            columns.append((ok.any(axis=1), (newmean - newCI / 2).tolist(), newmean.tolist(), \
+                            (newmean + newCI / 2).tolist()))
+            names.append(g if len(schemes) == 1 else g + "_" + scheme)
+
+    lines = ["#Event" + "".join(["\t" + "\t".join([n + "_low", n + "_mean", n + "_high"]) \
+                                 for n in names]) + "\tGene\tSymb\tDesc\n"]
+    for j in range(len(events)):
+        line = [events[j]]
+        for has, lows, means, highs in columns:
+            if has[j]:
+                line += map(str, [max([0, round(lows[j], 2)]), round(means[j], 2), \
+                                  min([1, round(highs[j], 2)])])
+            else:
+                line += ["n/a", "n/a", "n/a"]
+        lines.append("\t".join(line + [genes[j]]) + "\n")
+
+    out = open(out_f, 'w')
+    out.writelines(lines)
     out.close()
@@ -1,10 +1,23 @@
 import sys
-import os
 
-fxn = sys.argv[1]
-[module,method] = fxn.split(".")
-module = __import__("%s" %module)
 
-# Run the command
-args = ["sys.argv["+str(i)+"]" for i in range(2,len(sys.argv))]
-eval("module."+method+"("+",".join(args)+")")
+def run(fxn, args):
+    """ Call <module>.<function> with the given string arguments, importing only <module>
+
+    Args:
+        fxn (str): Function to run, i.e. misoWrapper.runMISO
+        args (list): Arguments passed to the function as strings
+
+    Returns:
+        The return value of the function
+
+    """
+    module, method = fxn.split(".")
+    module = __import__(module)
+    return getattr(module, method)(*args)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        exit("Usage: python script.py <module>.<function> [arguments]")
+    run(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,131 @@
+import os, sys, json, socket, traceback, SocketServer
+from cStringIO import StringIO
+import script
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    """ Run one script.py call per connection, in a child forked from the preloaded worker """
+
+    def handle(self):
+        out = StringIO()
+        sys.stdout = sys.stderr = out
+        try:
+            request = json.loads(self.rfile.readline())
+            os.chdir(request['cwd'])
+            args = [a.encode('utf-8') for a in request['args']]
+            script.run(request['fxn'].encode('utf-8'), args)
+            status = 0
+        except SystemExit, e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                print e.code
+                status = 1
+        except:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout = sys.__stdout__
+            sys.stderr = sys.__stderr__
+
+        # Scripts may print raw bytes, which json.dumps would refuse
+        output = out.getvalue()
+        if isinstance(output, str):
+            output = output.decode('utf-8', 'replace')
+        self.wfile.write(json.dumps({'status': status, 'output': output}) + "\n")
+
+
+class _Server(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+    pass
+
+
+def serve(socket_f, preload='misoWrapper,miso_utils,misopy.settings,misopy.run_events_analysis'):
+    """ Start a worker listening for script.py calls on a Unix socket
+
+    Args:
+        socket_f (str/path): Unix socket to listen on
+        preload (str): Comma delimited modules imported once at start-up, i.e. numpy/matplotlib/misopy users. Modules that cannot be imported are skipped
+
+    Returns:
+        Nothing. Serves until killed; each call runs in a forked child, so imports and loaded settings are reused.
+
+    """
+    for module in preload.split(","):
+        if module:
+            try:
+                __import__(module)
+            except ImportError, e:
+                print 'Not preloading', module + ':', e
+    if os.path.exists(socket_f):
+        os.remove(socket_f)
+    server = _Server(socket_f, _Handler)
+    print 'Serving on', socket_f
+    try:
+        server.serve_forever()
+    finally:
+        os.remove(socket_f)
+
+
+def call(socket_f, fxn, *args):
+    """ Run a script.py call on a worker started with serve
+
+    Args:
+        socket_f (str/path): Unix socket of the worker
+        fxn (str): Function to run, i.e. miso_utils.fancyScatter
+        args (str): Arguments passed to the function, as on the script.py command line
+
+    Returns:
+        Int. Exit status of the call (0 on success). Output of the call is printed.
+
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(socket_f)
+    f = conn.makefile('rw')
+    f.write(json.dumps({'fxn': fxn, 'args': list(args), 'cwd': os.getcwd()}) + "\n")
+    f.flush()
+    response = json.loads(f.readline())
+    f.close()
+    conn.close()
+    sys.stdout.write(response['output'].encode('utf-8'))
+    return response['status']
+
+
+def batch(socket_f, calls_f, nparallel=8):
+    """ Run many script.py calls on a worker started with serve
+
+    Args:
+        socket_f (str/path): Unix socket of the worker
+        calls_f (str/path): Text file with one call per line: <module>.<function> [arguments], whitespace delimited
+        nparallel (int): Number of calls running at once
+
+    Returns:
+        Int. Number of failed calls
+
+    """
+    from multiprocessing.pool import ThreadPool
+    calls = [line.split() for line in open(calls_f) \
+        if line.strip() and not line.startswith("#")]
+    pool = ThreadPool(int(nparallel))
+    try:
+        statuses = pool.map(lambda c: call(socket_f, *c), calls)
+    finally:
+        pool.close()
+        pool.join()
+    failed = [" ".join(c) for c, status in zip(calls, statuses) if status != 0]
+    for c in failed:
+        print 'FAILED:', c
+    return len(failed)
+
+
+if __name__ == "__main__":
+    usage = "Usage: python scriptDaemon.py serve <socket> [preload modules]\n" + \
+        "       python scriptDaemon.py call <socket> <module>.<function> [arguments]\n" + \
+        "       python scriptDaemon.py batch <socket> <calls file> [nparallel]"
+    if len(sys.argv) < 3 or sys.argv[1] not in ['serve', 'call', 'batch']:
+        exit(usage)
+    if sys.argv[1] == 'serve':
+        serve(*sys.argv[2:])
+    elif sys.argv[1] == 'call':
+        sys.exit(call(*sys.argv[2:]))
+    else:
+        sys.exit(min(batch(*sys.argv[2:]), 1))